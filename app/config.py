@@ -7,21 +7,111 @@ load_dotenv()
 
 class Settings(BaseSettings):
     DATABASE_URL: str = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/ailegal")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "20"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_CREATE_ALL: bool = os.getenv("DB_CREATE_ALL", "false").lower() == "true"
     SECRET_KEY: str = os.getenv("SECRET_KEY", "")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+    PASSWORD_HASH_MAX_CONCURRENCY: int = int(os.getenv("PASSWORD_HASH_MAX_CONCURRENCY", "16"))
+    PASSWORD_HASH_QUEUE_TIMEOUT: float = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+    USER_CACHE_TTL: float = float(os.getenv("USER_CACHE_TTL", "60"))
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
     DIFY_API_KEY: str = os.getenv("DIFY_API_KEY", "app-mrSJv6FHy1YmsVM4LPQHvBAY")
     DIFY_API_BASE_URL: str = os.getenv("DIFY_API_BASE_URL", "http://localhost/v1")
+    DIFY_REQUEST_TIMEOUT: float = float(os.getenv("DIFY_REQUEST_TIMEOUT", "120"))
+    DIFY_CONNECT_TIMEOUT: float = float(os.getenv("DIFY_CONNECT_TIMEOUT", "10"))
+    DIFY_STREAM_READ_TIMEOUT: float = float(os.getenv("DIFY_STREAM_READ_TIMEOUT", "60"))
+    DIFY_POOL_LIMIT: int = int(os.getenv("DIFY_POOL_LIMIT", "100"))
+    DIFY_POOL_LIMIT_PER_HOST: int = int(os.getenv("DIFY_POOL_LIMIT_PER_HOST", "50"))
+    DIFY_KEEPALIVE_TIMEOUT: float = float(os.getenv("DIFY_KEEPALIVE_TIMEOUT", "30"))
+    DIFY_DNS_CACHE_TTL: int = int(os.getenv("DIFY_DNS_CACHE_TTL", "300"))
+    # Узлы Dify с общей базой: "http://dify-1/v1=2;http://dify-2/v1=1"; пусто - только DIFY_API_BASE_URL
+    DIFY_BACKENDS: str = os.getenv("DIFY_BACKENDS", "")
+    DIFY_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("DIFY_BREAKER_FAILURE_THRESHOLD", "5"))
+    DIFY_BREAKER_RESET_TIMEOUT: float = float(os.getenv("DIFY_BREAKER_RESET_TIMEOUT", "30"))
+    DIFY_BREAKER_SLOW_CALL_SECONDS: float = float(os.getenv("DIFY_BREAKER_SLOW_CALL_SECONDS", "90"))
+    # Хедж дублирует генерацию на втором узле; только для чтений и первых сообщений
+    DIFY_HEDGE_ENABLED: bool = os.getenv("DIFY_HEDGE_ENABLED", "false").lower() == "true"
+    DIFY_HEDGE_DELAY: float = float(os.getenv("DIFY_HEDGE_DELAY", "5"))
+    # Справедливая очередь генераций: общий лимит, лимит на пользователя, максимум ожидания
+    DIFY_SCHEDULER_ENABLED: bool = os.getenv("DIFY_SCHEDULER_ENABLED", "true").lower() == "true"
+    DIFY_MAX_CONCURRENT_GENERATIONS: int = int(os.getenv("DIFY_MAX_CONCURRENT_GENERATIONS", "50"))
+    DIFY_MAX_GENERATIONS_PER_USER: int = int(os.getenv("DIFY_MAX_GENERATIONS_PER_USER", "3"))
+    DIFY_MAX_QUEUE_WAIT: float = float(os.getenv("DIFY_MAX_QUEUE_WAIT", "30"))
+    DIFY_SINGLE_FLIGHT_ENABLED: bool = os.getenv("DIFY_SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+    DIFY_CLEANUP_CONCURRENCY: int = int(os.getenv("DIFY_CLEANUP_CONCURRENCY", "8"))
+    DIFY_OUTBOX_BATCH_SIZE: int = int(os.getenv("DIFY_OUTBOX_BATCH_SIZE", "100"))
+    DIFY_OUTBOX_MAX_ATTEMPTS: int = int(os.getenv("DIFY_OUTBOX_MAX_ATTEMPTS", "10"))
+    DIFY_OUTBOX_BACKOFF_BASE: float = float(os.getenv("DIFY_OUTBOX_BACKOFF_BASE", "5"))
+    DIFY_OUTBOX_BACKOFF_MAX: float = float(os.getenv("DIFY_OUTBOX_BACKOFF_MAX", "3600"))
+    DIFY_OUTBOX_POLL_INTERVAL: float = float(os.getenv("DIFY_OUTBOX_POLL_INTERVAL", "5"))
+    TOKEN_SWEEP_ENABLED: bool = os.getenv("TOKEN_SWEEP_ENABLED", "true").lower() == "true"
+    TOKEN_SWEEP_INTERVAL: float = float(os.getenv("TOKEN_SWEEP_INTERVAL", "3600"))
+    TOKEN_SWEEP_BATCH_SIZE: int = int(os.getenv("TOKEN_SWEEP_BATCH_SIZE", "1000"))
+
+    ANSWER_CACHE_ENABLED: bool = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+    ANSWER_CACHE_BACKEND: str = os.getenv("ANSWER_CACHE_BACKEND", "memory")
+    ANSWER_CACHE_REDIS_URL: str = os.getenv("ANSWER_CACHE_REDIS_URL", "redis://localhost:6379/0")
+    ANSWER_CACHE_TTL: float = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_SIZE: int = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_PATH: str = os.getenv("METRICS_PATH", "/metrics")
+
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LIBRARY_LEVEL: str = os.getenv("LOG_LIBRARY_LEVEL", "WARNING")
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")
+    LOG_DEBUG_SAMPLE_RATE: float = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+    HEALTH_CACHE_TTL: float = float(os.getenv("HEALTH_CACHE_TTL", "5"))
+    HEALTH_PROBE_TIMEOUT: float = float(os.getenv("HEALTH_PROBE_TIMEOUT", "2"))
+    HEALTH_DIFY_REQUIRED: bool = os.getenv("HEALTH_DIFY_REQUIRED", "true").lower() == "true"
+
+    RATE_LIMIT_ENABLED: bool = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_REDIS_URL: str = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+    RATE_LIMIT_MAX_KEYS: int = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+    RATE_LIMIT_TRUST_FORWARDED: bool = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+    # "METHOD /path=burst/seconds;..." - token bucket на маршрут и пользователя/IP
+    RATE_LIMIT_RULES: str = os.getenv(
+        "RATE_LIMIT_RULES",
+        "POST /api/auth/login=10/60;"
+        "POST /api/auth/register=5/300;"
+        "POST /api/auth/verify-email=10/300;"
+        "POST /api/auth/resend-verification=5/300;"
+        "POST /api/auth/forgot-password=5/300;"
+        "POST /api/auth/reset-password=10/300;"
+        "POST /api/chat/message=30/60;"
+        "POST /api/chat/message/stream=30/60"
+    )
     
     SMTP_SERVER: str = os.getenv("SMTP_SERVER", "smtp.gmail.com")
     SMTP_PORT: int = int(os.getenv("SMTP_PORT", "587"))
     SMTP_USERNAME: str = os.getenv("SMTP_USERNAME", "")
     SMTP_PASSWORD: str = os.getenv("SMTP_PASSWORD", "")
     FROM_EMAIL: str = os.getenv("FROM_EMAIL", "")
+    SMTP_USE_TLS: bool = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
+    SMTP_TIMEOUT: float = float(os.getenv("SMTP_TIMEOUT", "30"))
+    SMTP_IDLE_TIMEOUT: float = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+    SMTP_BATCH_SIZE: int = int(os.getenv("SMTP_BATCH_SIZE", "20"))
+    SMTP_RATE_LIMIT: float = float(os.getenv("SMTP_RATE_LIMIT", "5"))
+    SMTP_MAX_RETRIES: int = int(os.getenv("SMTP_MAX_RETRIES", "5"))
+    SMTP_RETRY_BACKOFF: float = float(os.getenv("SMTP_RETRY_BACKOFF", "2"))
+    SMTP_QUEUE_SIZE: int = int(os.getenv("SMTP_QUEUE_SIZE", "10000"))
     
     GOOGLE_CLIENT_ID: str = os.getenv("GOOGLE_CLIENT_ID", "")
     GOOGLE_CLIENT_SECRET: str = os.getenv("GOOGLE_CLIENT_SECRET", "")
     GOOGLE_REDIRECT_URI: str = os.getenv("GOOGLE_REDIRECT_URI", "")
+    OAUTH_HTTP2: bool = os.getenv("OAUTH_HTTP2", "true").lower() == "true"
+    OAUTH_HTTP_TIMEOUT: float = float(os.getenv("OAUTH_HTTP_TIMEOUT", "10"))
+    OAUTH_HTTP_MAX_CONNECTIONS: int = int(os.getenv("OAUTH_HTTP_MAX_CONNECTIONS", "20"))
+    OAUTH_HTTP_MAX_KEEPALIVE: int = int(os.getenv("OAUTH_HTTP_MAX_KEEPALIVE", "10"))
+    OAUTH_DISCOVERY_CACHE_TTL: int = int(os.getenv("OAUTH_DISCOVERY_CACHE_TTL", "3600"))
     
 
     ENVIRONMENT: str = os.getenv("ENVIRONMENT", "development")
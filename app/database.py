@@ -1,18 +1,55 @@
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config import settings
+from services.metrics import instrument_engine, db_pool_checkout_seconds, db_pool_checkout_timeouts_total
 
-SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
+def get_async_database_url(url: str) -> str:
+    """Map a plain DATABASE_URL onto its async driver (asyncpg / aiosqlite)"""
+    if url.startswith(("postgresql://", "postgres://", "postgresql+psycopg2://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url.split("://", 1)[1]
+    return url
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited and how many timed out"""
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            db_pool_checkout_timeouts_total.inc()
+            raise
+        finally:
+            db_pool_checkout_seconds.observe(time.perf_counter() - started)
+
+def get_engine_options(url: str) -> dict:
+    """Pool settings from config; in-memory SQLite keeps SQLAlchemy's single-connection pool"""
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith("sqlite+aiosqlite:")):
+        return {}
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        # Соединения старше recycle пересоздаются; pre_ping отсеивает умершие после рестарта Postgres
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+SQLALCHEMY_DATABASE_URL = get_async_database_url(settings.DATABASE_URL)
+
+engine = create_async_engine(SQLALCHEMY_DATABASE_URL, **get_engine_options(SQLALCHEMY_DATABASE_URL))
+if settings.METRICS_ENABLED:
+    instrument_engine(engine)
+# expire_on_commit=False: после commit атрибуты не перезагружаются лениво (в async это невозможно)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,20 +1,62 @@
 from fastapi import FastAPI, Request, Depends
 from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import status
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
 import os
 
 from database import engine, Base, get_db
-from routers import auth, chat, oauth
+from routers import auth, chat, oauth, health
 from models import models
+from services.dify_service import dify_service
+from services.auth_service import password_hash_executor
+from services.mail_service import mail_dispatcher
+from services.oauth_service import google_oauth
+from services.dify_outbox import start_outbox_worker, stop_outbox_worker
+from services.token_sweeper import start_token_sweeper, stop_token_sweeper
+from services.metrics import MetricsMiddleware, render_metrics
+from services.rate_limit import RateLimitMiddleware
+from services.structured_logging import RequestIdMiddleware, setup_logging, stop_logging
+from config import settings
 
-Base.metadata.create_all(bind=engine)
+setup_logging()
 
-app = FastAPI(title="AI Legal Assistant API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Схемой управляет Alembic (cd app && alembic upgrade head); create_all - только для
+    # одноразовых баз в бенчмарках и локальных проверках
+    if settings.DB_CREATE_ALL:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    await dify_service.start()
+    # Фоновый воркер применяет rename/delete из outbox к Dify
+    start_outbox_worker()
+    await mail_dispatcher.start()
+    await google_oauth.start()
+    # Просроченные и использованные токены иначе копятся бесконечно
+    if settings.TOKEN_SWEEP_ENABLED:
+        start_token_sweeper()
+    try:
+        yield
+    finally:
+        await stop_token_sweeper()
+        await google_oauth.close()
+        await mail_dispatcher.stop()
+        await stop_outbox_worker()
+        await dify_service.close()
+        await engine.dispose()
+        password_hash_executor.shutdown(wait=False)
+        stop_logging()
+
+app = FastAPI(title="AI Legal Assistant API", lifespan=lifespan)
+
+# Внутри CORS, чтобы ответы 429 тоже несли CORS-заголовки и были видны фронтенду
+if settings.RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware)
 
 # Add CORS middleware for React frontend
 app.add_middleware(
@@ -25,6 +67,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Снаружи CORS, чтобы учитывать и preflight-запросы
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+# Самый внешний слой: request id виден во всех логах запроса, включая ошибки middleware
+app.add_middleware(RequestIdMiddleware)
+
 # Serve static files (if needed for file uploads, etc.)
 if os.path.exists("static"):
     app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -33,6 +81,7 @@ if os.path.exists("static"):
 app.include_router(auth.router, prefix="/api/auth")
 app.include_router(chat.router, prefix="/api/chat")
 app.include_router(oauth.oauth_router, prefix="/api")
+app.include_router(health.router)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -57,8 +106,15 @@ async def root():
 
 @app.get("/health")
 async def health_check():
+    # Оставлен для совместимости; балансировщику нужен /health/ready
     return {"status": "healthy"}
 
+if settings.METRICS_ENABLED:
+    @app.get(settings.METRICS_PATH, include_in_schema=False)
+    async def metrics():
+        """Prometheus text exposition of request, DB, Dify and pool metrics"""
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
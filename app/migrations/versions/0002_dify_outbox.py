@@ -0,0 +1,46 @@
+"""dify outbox table
+
+Durable queue of Dify rename/delete operations (services/dify_outbox.py).
+IF NOT EXISTS keeps the upgrade safe on databases where create_all already made it.
+
+Revision ID: 0002_dify_outbox
+Revises: 0001_baseline
+Create Date: 2026-10-18 12:05:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002_dify_outbox"
+down_revision: Union[str, None] = "0001_baseline"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "dify_outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("operation", sa.String(), nullable=False),
+        sa.Column("dify_conversation_id", sa.String(), nullable=False),
+        sa.Column("dify_user", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        if_not_exists=True,
+    )
+    op.create_index("ix_dify_outbox_id", "dify_outbox", ["id"], if_not_exists=True)
+    op.create_index("ix_dify_outbox_next_attempt_at", "dify_outbox", ["next_attempt_at"], if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("dify_outbox")
@@ -0,0 +1,54 @@
+"""composite indexes for hot queries
+
+- messages(conversation_id, created_at, id): keyset-paginated chat history
+- conversations(user_id, updated_at): a user's conversation list, newest first
+- password_reset_tokens / email_verification_tokens (email, expires_at):
+  code checks and per-email cleanup of live tokens
+
+On large Postgres tables run this in a maintenance window or create the
+indexes CONCURRENTLY by hand first; IF NOT EXISTS then makes this a no-op.
+
+Revision ID: 0003_hot_query_indexes
+Revises: 0002_dify_outbox
+Create Date: 2026-10-18 12:10:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003_hot_query_indexes"
+down_revision: Union[str, None] = "0002_dify_outbox"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        "ix_messages_conversation_created_id", "messages",
+        ["conversation_id", "created_at", "id"], if_not_exists=True
+    )
+    op.create_index(
+        "ix_conversations_user_updated", "conversations",
+        ["user_id", "updated_at"], if_not_exists=True
+    )
+    op.create_index(
+        "ix_password_reset_tokens_email_expires", "password_reset_tokens",
+        ["email", "expires_at"], if_not_exists=True
+    )
+    op.create_index(
+        "ix_email_verification_tokens_email_expires", "email_verification_tokens",
+        ["email", "expires_at"], if_not_exists=True
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_email_verification_tokens_email_expires", table_name="email_verification_tokens")
+    op.drop_index("ix_password_reset_tokens_email_expires", table_name="password_reset_tokens")
+    op.drop_index("ix_conversations_user_updated", table_name="conversations")
+    op.drop_index("ix_messages_conversation_created_id", table_name="messages")
@@ -0,0 +1,87 @@
+"""full-text search over messages
+
+- Postgres: generated messages.search_vector (russian + english + simple
+  configs; Kazakh has no built-in dictionary and is matched by 'simple')
+  with a GIN index. Adding a stored generated column rewrites the table -
+  run it in a maintenance window on a large database.
+- SQLite: external-content FTS5 table messages_fts kept in sync by triggers,
+  backfilled with 'rebuild'. A later batch migration that recreates the
+  messages table drops these triggers and has to create them again.
+
+Revision ID: 0004_message_search
+Revises: 0003_hot_query_indexes
+Create Date: 2026-10-18 20:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004_message_search"
+down_revision: Union[str, None] = "0003_hot_query_indexes"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+POSTGRES_UPGRADE = [
+    """
+    ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('russian', coalesce(query, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(query, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(query, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(answer, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(answer, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(answer, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages USING GIN (search_vector)",
+]
+
+SQLITE_UPGRADE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        query, answer, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, query, answer) VALUES (new.id, new.query, new.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF query, answer ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);
+        INSERT INTO messages_fts(rowid, query, answer) VALUES (new.id, new.query, new.answer);
+    END
+    """,
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    statements = {"postgresql": POSTGRES_UPGRADE, "sqlite": SQLITE_UPGRADE}.get(dialect, [])
+    for statement in statements:
+        op.execute(sa.text(statement))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.execute("DROP INDEX IF EXISTS ix_messages_search_vector")
+        op.execute("ALTER TABLE messages DROP COLUMN IF EXISTS search_vector")
+    elif dialect == "sqlite":
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_update")
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+        op.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text, Index, DDL, event
 from sqlalchemy.orm import relationship
 import datetime
 from database import Base
@@ -35,6 +35,11 @@ class Conversation(Base):
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation")
 
+    __table_args__ = (
+        # Список бесед пользователя: WHERE user_id = ? ORDER BY updated_at DESC
+        Index("ix_conversations_user_updated", "user_id", "updated_at"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -46,6 +51,58 @@ class Message(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     conversation = relationship("Conversation", back_populates="messages")
+
+    __table_args__ = (
+        # Keyset-пагинация истории: WHERE conversation_id = ? ORDER BY created_at, id
+        Index("ix_messages_conversation_created_id", "conversation_id", "created_at", "id"),
+    )
+
+# Полнотекстовый поиск по query/answer. Postgres: сгенерированный tsvector (ru + en + simple
+# для казахского, которого нет среди словарей) с GIN-индексом; SQLite: внешняя FTS5-таблица,
+# которую синхронизируют триггеры. Схему создает миграция 0004_message_search,
+# эти DDL нужны только для DB_CREATE_ALL.
+MESSAGE_SEARCH_DDL = {
+    "postgresql": [
+        """
+        ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('russian', coalesce(query, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(query, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(query, '')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(answer, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(answer, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(answer, '')), 'B')
+        ) STORED
+        """,
+        "CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            query, answer, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, query, answer) VALUES (new.id, new.query, new.answer);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF query, answer ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);
+            INSERT INTO messages_fts(rowid, query, answer) VALUES (new.id, new.query, new.answer);
+        END
+        """,
+    ],
+}
+
+for dialect_name, statements in MESSAGE_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect=dialect_name))
     
 class PasswordResetToken(Base):
     __tablename__ = "password_reset_tokens"
@@ -56,6 +113,11 @@ class PasswordResetToken(Base):
     expires_at = Column(DateTime)
     used = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # Выдача/очистка токенов по email с учетом срока действия
+        Index("ix_password_reset_tokens_email_expires", "email", "expires_at"),
+    )
+
 class EmailVerificationToken(Base):
     __tablename__ = "email_verification_tokens"
     
@@ -64,4 +126,22 @@ class EmailVerificationToken(Base):
     code = Column(String, index=True)
     expires_at = Column(DateTime)
     used = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # Проверка кода: WHERE email = ? AND expires_at > now()
+        Index("ix_email_verification_tokens_email_expires", "email", "expires_at"),
+    )
+
+class DifyOutbox(Base):
+    __tablename__ = "dify_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    operation = Column(String, nullable=False)
+    dify_conversation_id = Column(String, nullable=False)
+    dify_user = Column(String, nullable=False)
+    name = Column(String, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, BackgroundTasks, Response
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 from typing import Annotated
 from pydantic import BaseModel, EmailStr, Field, model_validator
@@ -63,10 +64,10 @@ class ForgotPasswordRequest(BaseModel):
 async def register(
     register_data: RegisterRequest,
     bg: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if email already exists
-    existing_user = db.query(User).filter(User.email == register_data.email).first()
+    existing_user = await get_user_by_email(db, register_data.email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -74,15 +75,19 @@ async def register(
         )
     
     # Check if username already exists
-    existing_username = db.query(User).filter(User.username == register_data.username).first()
+    result = await db.execute(select(User).where(User.username == register_data.username))
+    existing_username = result.scalars().first()
     if existing_username:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already taken"
         )
     
+    # Завершаем читающую транзакцию, чтобы не держать соединение из пула во время bcrypt
+    await db.commit()
+
     # Create user (but don't verify email yet)
-    hashed_password = get_password_hash(register_data.password)
+    hashed_password = await get_password_hash(register_data.password)
     new_user = User(
         email=register_data.email, 
         username=register_data.username, 
@@ -91,11 +96,11 @@ async def register(
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     
     # Create verification token and send email
-    verification_code = create_email_verification_token(db, register_data.email)
+    verification_code = await create_email_verification_token(db, register_data.email)
     bg.add_task(send_verification_email, verification_code, register_data.email)
     
     return {
@@ -107,10 +112,10 @@ async def register(
 @router.post("/verify-email")
 async def verify_email(
     verification_data: EmailVerificationRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Get verification token
-    token_record = get_verification_token(db, verification_data.email, verification_data.verification_code)
+    token_record = await get_verification_token(db, verification_data.email, verification_data.verification_code)
     
     if not token_record:
         raise HTTPException(
@@ -119,7 +124,7 @@ async def verify_email(
         )
     
     # Verify user's email
-    user = verify_user_email(db, verification_data.email)
+    user = await verify_user_email(db, verification_data.email)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -127,7 +132,7 @@ async def verify_email(
         )
     
     # Mark token as used
-    use_verification_token(db, token_record)
+    await use_verification_token(db, token_record)
     
     return {
         "message": "Email verified successfully!",
@@ -138,7 +143,7 @@ async def verify_email(
 async def resend_verification(
     email_data: dict,
     bg: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     email = email_data.get("email")
     if not email:
@@ -148,7 +153,7 @@ async def resend_verification(
         )
     
     # Check if user exists
-    user = get_user_by_email(db, email)
+    user = await get_user_by_email(db, email)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -163,7 +168,7 @@ async def resend_verification(
         )
     
     # Create new verification token and send email
-    verification_code = create_email_verification_token(db, email)
+    verification_code = await create_email_verification_token(db, email)
     bg.add_task(send_verification_email, verification_code, email)
     
     return {"message": "Verification code sent successfully!"}
@@ -172,9 +177,9 @@ async def resend_verification(
 async def login(
     login_data: LoginRequest,
     response: Response,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = authenticate_user(db, login_data.email, login_data.password)
+    user = await authenticate_user(db, login_data.email, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -239,12 +244,12 @@ async def get_current_user_info(
 async def forgot_password(
     forgot_password_data: ForgotPasswordRequest,
     bg: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = get_user_by_email(db, forgot_password_data.email)
+    user = await get_user_by_email(db, forgot_password_data.email)
     
     if user:
-        reset_token = create_password_reset_token(db, forgot_password_data.email)
+        reset_token = await create_password_reset_token(db, forgot_password_data.email)
         bg.add_task(
             send_password_reset_email,
             reset_token,
@@ -257,9 +262,9 @@ async def forgot_password(
 @router.post("/reset-password")
 async def reset_password(
     request: ResetPasswordRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    token_record = get_reset_token(db, request.token)
+    token_record = await get_reset_token(db, request.token)
     
     if not token_record:
         raise HTTPException(
@@ -267,12 +272,12 @@ async def reset_password(
             detail="Invalid or expired reset token"
         )
     
-    user = update_user_password(db, token_record.email, request.new_password)
+    user = await update_user_password(db, token_record.email, request.new_password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User not found"
         )
     
-    use_reset_token(db, token_record)
+    await use_reset_token(db, token_record)
     return {"message": "Password reset successfully"}
\ No newline at end of file
@@ -1,17 +1,37 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Cookie
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Cookie, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional, List, Dict
 from pydantic import BaseModel
+import contextlib
 import datetime
+import json
+import logging
 
-from database import get_db
+from database import get_db, SessionLocal
 from models.models import User, Conversation, Message
 from services.auth_service import get_current_user
-from services.dify_service import DifyService
+from services.dify_service import dify_service, DifyUnavailableError
+from services.dify_scheduler import QueueTimeoutError
+from services.answer_cache import answer_cache
+from services.pagination import encode_cursor, decode_cursor
+from services.message_search import search_messages, render_snippet
+from services.dify_outbox import enqueue_conversation_deletions, enqueue_conversation_rename, notify_outbox_worker
 
 router = APIRouter(tags=["chat"])
-dify_service = DifyService()
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+CONVERSATIONS_PAGE_SIZE = 50
+CONVERSATIONS_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+# Ранжированную выдачу листаем OFFSET'ом - глубокие страницы ограничиваем
+SEARCH_MAX_OFFSET = 1000
+# Сколько последних сообщений передаем в Dify, когда беседа в Dify создается не с первого сообщения
+SEED_HISTORY_MESSAGES = 5
 
 class MessageRequest(BaseModel):
     message: str
@@ -20,19 +40,64 @@ class MessageRequest(BaseModel):
 class RenameConversationRequest(BaseModel):
     name: str
 
+class BulkDeleteRequest(BaseModel):
+    conversation_ids: Optional[List[int]] = None
+    older_than: Optional[datetime.datetime] = None
+
 def safe_isoformat(dt):
     """Safely convert datetime to ISO format, handling None values"""
     if dt is None:
         return datetime.datetime.utcnow().isoformat()
     return dt.isoformat()
 
+def auto_name_conversation(conversation: Conversation, query: str):
+    """Rename a "New Chat" conversation after its first message"""
+    if conversation.name == "New Chat" and len(query.strip()) > 0:
+        # Берем первые 30 символов сообщения как название
+        new_name = query.strip()[:30]
+        if len(query.strip()) > 30:
+            new_name += "..."
+        conversation.name = new_name
+        logger.debug("Auto-renamed conversation", extra={"conversation_id": conversation.id, "conversation_name": new_name})
+
+async def load_seed_history(db: AsyncSession, conversation: Conversation) -> list:
+    """
+    Messages already answered without a Dify conversation (answer cache hit or a
+    coalesced question); empty once the conversation exists in Dify
+    """
+    if conversation.dify_conversation_id:
+        return []
+    result = await db.execute(
+        select(Message.query, Message.answer)
+        .where(Message.conversation_id == conversation.id)
+        .order_by(Message.id.desc())
+        .limit(SEED_HISTORY_MESSAGES)
+    )
+    return list(reversed(result.all()))
+
+def seeded_query(history: list, query: str) -> str:
+    """Prefix the query with the earlier turns, so the new Dify conversation keeps their context"""
+    if not history:
+        return query
+    lines = ["Earlier in this conversation:"]
+    for message in history:
+        lines.append(f"User: {message.query}")
+        lines.append(f"Assistant: {message.answer}")
+    lines.append("")
+    lines.append(f"User: {query}")
+    return "\n".join(lines)
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @router.post("/new")
 async def create_new_chat(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        print(f"Creating new chat for user: {current_user.username}")
+        logger.debug("Creating new chat", extra={"user": current_user.username})
         
         
         conversation = Conversation(
@@ -42,8 +107,8 @@ async def create_new_chat(
         )
         
         db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
+        await db.commit()
+        await db.refresh(conversation)
         
         return {
             "id": conversation.id,
@@ -53,17 +118,17 @@ async def create_new_chat(
             "updated_at": safe_isoformat(conversation.updated_at)
         }
     except Exception as e:
-        print(f"Error creating chat: {str(e)}")
+        logger.exception("Error creating chat")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/message")
 async def send_message(
     message_data: MessageRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        print(f"Sending message for user: {current_user.username}")
+        logger.debug("Sending message", extra={"user": current_user.username})
         
         # Если conversation_id не указан, создаем новую беседу
         if not message_data.conversation_id:
@@ -73,31 +138,56 @@ async def send_message(
                 user_id=current_user.id
             )
             db.add(conversation)
-            db.commit()
-            db.refresh(conversation)
+            await db.commit()
+            await db.refresh(conversation)
         else:
-            conversation = db.query(Conversation).filter(
+            result = await db.execute(select(Conversation).where(
                 Conversation.id == message_data.conversation_id, 
                 Conversation.user_id == current_user.id
-            ).first()
+            ))
+            conversation = result.scalars().first()
             if not conversation:
                 raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Если у беседы нет dify_conversation_id, создаем его сейчас
-        if not conversation.dify_conversation_id:
-            print(f"Creating new Dify conversation for first message")
-            # Первое сообщение - создаем conversation в Dify
-            result = await dify_service.send_message(
-                query=message_data.message,
-                user_id=current_user.username,
-                conversation_id=None  # Новая беседа в Dify
+        # Первое сообщение новой беседы можно отдать из кэша ответов (если включен)
+        is_first_turn = not message_data.conversation_id
+        cached_answer = None
+        if is_first_turn:
+            cached_answer = await answer_cache.get_answer(
+                message_data.message, dify_service.api_key, dify_service.base_url
             )
+
+        if cached_answer is not None:
+            logger.debug("Answer cache hit for first message")
+            # Беседа в Dify не создается - она появится при следующем сообщении, с этим ответом в контексте
+            result = {"answer": cached_answer, "message_id": None, "conversation_id": None}
+        # Если у беседы нет dify_conversation_id, создаем его сейчас
+        elif not conversation.dify_conversation_id:
+            logger.debug("Creating new Dify conversation", extra={"conversation_id": conversation.id})
+            history = await load_seed_history(db, conversation)
+            if history:
+                # Предыдущие ответы пришли из кэша или общего запроса - передаем их в новую беседу
+                result = await dify_service.send_scheduled_message(
+                    query=seeded_query(history, message_data.message),
+                    user_id=current_user.username
+                )
+            else:
+                # Первое сообщение - создаем conversation в Dify; одинаковые вопросы,
+                # уже отправленные другими пользователями, ждут общего ответа
+                result = await dify_service.send_first_message(
+                    query=message_data.message,
+                    user_id=current_user.username
+                )
             # Сохраняем conversation_id от Dify
             conversation.dify_conversation_id = result["conversation_id"]
+            if is_first_turn:
+                await answer_cache.store_answer(
+                    message_data.message, dify_service.api_key, dify_service.base_url, result["answer"]
+                )
         else:
-            print(f"Sending message to existing Dify conversation: {conversation.dify_conversation_id}")
+            logger.debug("Sending message to existing Dify conversation", extra={"dify_conversation_id": conversation.dify_conversation_id})
             # Обычное сообщение в существующую беседу
-            result = await dify_service.send_message(
+            result = await dify_service.send_scheduled_message(
                 query=message_data.message,
                 user_id=current_user.username,
                 conversation_id=conversation.dify_conversation_id
@@ -119,15 +209,9 @@ async def send_message(
             conversation.updated_at = datetime.datetime.utcnow()
             
         # Автоматически переименовываем чат на основе первого сообщения
-        if conversation.name == "New Chat" and len(message_data.message.strip()) > 0:
-            # Берем первые 30 символов сообщения как название
-            new_name = message_data.message.strip()[:30]
-            if len(message_data.message.strip()) > 30:
-                new_name += "..."
-            conversation.name = new_name
-            print(f"Auto-renamed conversation to: {new_name}")
+        auto_name_conversation(conversation, message_data.message)
         
-        db.commit()
+        await db.commit()
         
         return {
             "message_id": new_message.id,
@@ -136,55 +220,301 @@ async def send_message(
             "created_at": safe_isoformat(new_message.created_at),
             "conversation_name": conversation.name
         }
+    except DifyUnavailableError:
+        # Все узлы Dify с открытым breaker - отвечаем сразу, не дожидаясь таймаутов
+        raise HTTPException(status_code=503, detail="Assistant is temporarily unavailable, please try again later")
+    except QueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"Error sending message: {str(e)}")
+        logger.exception("Error sending message")
         raise HTTPException(status_code=500, detail=str(e))
         
+@router.post("/message/stream")
+async def stream_message(
+    message_data: MessageRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        logger.debug("Streaming message", extra={"user": current_user.username})
+
+        if not message_data.conversation_id:
+            conversation = Conversation(
+                dify_conversation_id=None,  # Придет в message_end
+                name="New Chat",
+                user_id=current_user.id
+            )
+            db.add(conversation)
+            await db.commit()
+            await db.refresh(conversation)
+        else:
+            result = await db.execute(select(Conversation).where(
+                Conversation.id == message_data.conversation_id,
+                Conversation.user_id == current_user.id
+            ))
+            conversation = result.scalars().first()
+            if not conversation:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+
+        dify_query = seeded_query(await load_seed_history(db, conversation), message_data.message)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error streaming message")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    conversation_id = conversation.id
+    dify_conversation_id = conversation.dify_conversation_id
+    username = current_user.username
+
+    # Слот генерации берем до ответа: после отправки заголовков 200 отказ очереди уже не вернуть статусом
+    slot = contextlib.AsyncExitStack()
+    try:
+        await slot.enter_async_context(dify_service.generation_slot(username))
+    except QueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    async def event_stream():
+        answer_parts = []
+        dify_message_id = None
+        new_dify_conversation_id = dify_conversation_id
+
+        try:
+            yield sse_event("conversation", {"conversation_id": conversation_id})
+
+            async for event in dify_service.stream_message(
+                query=dify_query,
+                user_id=username,
+                conversation_id=dify_conversation_id
+            ):
+                event_type = event.get("event")
+                if event_type in ("message", "agent_message"):
+                    chunk = event.get("answer", "")
+                    answer_parts.append(chunk)
+                    yield sse_event("message", {"answer": chunk})
+                elif event_type == "message_end":
+                    dify_message_id = event.get("message_id")
+                    new_dify_conversation_id = event.get("conversation_id") or new_dify_conversation_id
+                elif event_type == "error":
+                    raise Exception(event.get("message", "Dify stream error"))
+
+            if not dify_message_id:
+                raise Exception("Dify stream ended without message_end")
+        except Exception as e:
+            logger.warning("Error streaming message", extra={"conversation_id": conversation_id, "error": str(e)})
+            yield sse_event("error", {"detail": str(e)})
+            return
+        finally:
+            # Генерация закончилась (или клиент ушел) - освобождаем слот до сохранения в БД
+            await slot.aclose()
+
+        # Ответ собран целиком - сохраняем сообщение отдельной сессией,
+        # так как сессия запроса уже закрыта к моменту стриминга
+        stream_db = SessionLocal()
+        try:
+            result = await stream_db.execute(select(Conversation).where(
+                Conversation.id == conversation_id
+            ))
+            stream_conversation = result.scalars().first()
+            if not stream_conversation:
+                raise Exception("Conversation not found")
+
+            if not stream_conversation.dify_conversation_id:
+                stream_conversation.dify_conversation_id = new_dify_conversation_id
+
+            answer = "".join(answer_parts)
+            new_message = Message(
+                dify_message_id=dify_message_id,
+                conversation_id=conversation_id,
+                query=message_data.message,
+                answer=answer
+            )
+            stream_db.add(new_message)
+            stream_conversation.updated_at = datetime.datetime.utcnow()
+            auto_name_conversation(stream_conversation, message_data.message)
+            await stream_db.commit()
+            await stream_db.refresh(new_message)
+
+            yield sse_event("message_end", {
+                "message_id": new_message.id,
+                "conversation_id": conversation_id,
+                "answer": answer,
+                "created_at": safe_isoformat(new_message.created_at),
+                "conversation_name": stream_conversation.name
+            })
+        except Exception as e:
+            await stream_db.rollback()
+            logger.exception("Error saving streamed message", extra={"conversation_id": conversation_id})
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            await stream_db.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def conversation_list_query(user_id: int, q: Optional[str] = None):
+    """Project only the columns the sidebar needs, optionally filtered by name prefix"""
+    query = select(
+        Conversation.id,
+        Conversation.name,
+        Conversation.created_at,
+        Conversation.updated_at
+    ).where(Conversation.user_id == user_id)
+    if q:
+        escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.where(Conversation.name.ilike(f"{escaped}%", escape="\\"))
+    return query
+
+def conversation_row_to_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "name": row.name,
+        "created_at": safe_isoformat(row.created_at),
+        "updated_at": safe_isoformat(row.updated_at)
+    }
+
 @router.get("/conversations")
 async def get_conversations(
+    q: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        print(f"Loading conversations for user: {current_user.username}")
-        conversations = db.query(Conversation).filter(
-            Conversation.user_id == current_user.id
-        ).order_by(Conversation.updated_at.desc().nulls_last()).all()
+        logger.debug("Loading conversations", extra={"user": current_user.username})
+        result = await db.execute(
+            conversation_list_query(current_user.id, q)
+            .order_by(Conversation.updated_at.desc().nulls_last())
+        )
         
-        result = []
-        for conversation in conversations:
-            result.append({
-                "id": conversation.id,
-                "name": conversation.name,
-                "created_at": safe_isoformat(conversation.created_at),
-                "updated_at": safe_isoformat(conversation.updated_at)
-            })
+        result = [conversation_row_to_dict(row) for row in result.all()]
         
-        print(f"Found {len(result)} conversations")
+        logger.debug("Loaded conversations", extra={"count": len(result)})
         return result
     except Exception as e:
-        print(f"Error loading conversations: {str(e)}")
+        logger.exception("Error loading conversations")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/conversations/page")
+async def get_conversations_page(
+    cursor: Optional[str] = None,
+    limit: int = Query(CONVERSATIONS_PAGE_SIZE, ge=1, le=CONVERSATIONS_MAX_PAGE_SIZE),
+    q: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        position = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        logger.debug("Loading conversations page", extra={"user": current_user.username})
+        # Keyset по (updated_at DESC, id DESC) с индексом conversations(user_id, updated_at)
+        query = conversation_list_query(current_user.id, q)
+        if position:
+            query = query.where(tuple_(Conversation.updated_at, Conversation.id) < position)
+        query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit + 1)
+
+        result = await db.execute(query)
+        rows = result.all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        return {
+            "conversations": [conversation_row_to_dict(row) for row in rows],
+            "has_more": has_more,
+            "next_cursor": encode_cursor(rows[-1].updated_at, rows[-1].id) if has_more else None
+        }
+    except Exception as e:
+        logger.exception("Error loading conversations")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/search")
+async def search_chat_history(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        logger.debug("Searching messages", extra={"user": current_user.username})
+        rows, has_more = await search_messages(db, current_user.id, q, limit, offset)
+
+        return {
+            "results": [
+                {
+                    "message_id": row["id"],
+                    "conversation_id": row["conversation_id"],
+                    "conversation_name": row["conversation_name"],
+                    "created_at": safe_isoformat(row["created_at"]),
+                    "score": round(float(row["score"]), 6),
+                    "query_snippet": render_snippet(row["query_snippet"]),
+                    "answer_snippet": render_snippet(row["answer_snippet"])
+                }
+                for row in rows
+            ],
+            "pagination": {
+                "limit": limit,
+                "offset": offset,
+                "has_more": has_more,
+                "next_offset": offset + limit if has_more and offset + limit <= SEARCH_MAX_OFFSET else None
+            }
+        }
+    except Exception as e:
+        logger.exception("Error searching messages")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/history/{conversation_id}")
 async def get_chat_history(
     conversation_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+    try:
+        cursor = decode_cursor(before or after) if (before or after) else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     try:
-        print(f"Loading history for conversation {conversation_id}, user: {current_user.username}")
-        conversation = db.query(Conversation).filter(
+        logger.debug("Loading history", extra={"conversation_id": conversation_id, "user": current_user.username})
+        result = await db.execute(select(Conversation).where(
             Conversation.id == conversation_id, 
             Conversation.user_id == current_user.id
-        ).first()
+        ))
+        conversation = result.scalars().first()
         
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        messages = db.query(Message).filter(
-            Message.conversation_id == conversation.id
-        ).order_by(Message.created_at.asc()).all()
+        # Keyset-пагинация по (created_at, id): без OFFSET, по индексу
+        # messages(conversation_id, created_at, id)
+        position = tuple_(Message.created_at, Message.id)
+        query = select(Message).where(Message.conversation_id == conversation.id)
+        if after:
+            query = query.where(position > cursor).order_by(Message.created_at.asc(), Message.id.asc())
+        else:
+            if before:
+                query = query.where(position < cursor)
+            query = query.order_by(Message.created_at.desc(), Message.id.desc())
+        result = await db.execute(query.limit(limit + 1))
+        messages = list(result.scalars().all())
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if not after:
+            # Страницы "до" выбираются от новых к старым, отдаем в хронологическом порядке
+            messages.reverse()
+        has_older = has_more if not after else True
+        has_newer = has_more if after else bool(before)
         
         result = []
         for message in messages:
@@ -195,7 +525,7 @@ async def get_chat_history(
                 "created_at": safe_isoformat(message.created_at)
             })
         
-        print(f"Found {len(result)} messages")
+        logger.debug("Loaded messages", extra={"conversation_id": conversation_id, "count": len(result)})
         return {
             "conversation": {
                 "id": conversation.id,
@@ -203,48 +533,101 @@ async def get_chat_history(
                 "created_at": safe_isoformat(conversation.created_at),
                 "updated_at": safe_isoformat(conversation.updated_at)
             },
-            "messages": result
+            "messages": result,
+            "pagination": {
+                "limit": limit,
+                "has_older": has_older and bool(messages),
+                "has_newer": has_newer and bool(messages),
+                "older_cursor": encode_cursor(messages[0].created_at, messages[0].id) if messages else None,
+                "newer_cursor": encode_cursor(messages[-1].created_at, messages[-1].id) if messages else None
+            }
         }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error loading history: {str(e)}")
+        logger.exception("Error loading history")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/conversations/{conversation_id}")
 async def delete_conversation(
     conversation_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)   
+    db: AsyncSession = Depends(get_db)   
 ):
     try:
-        conversation = db.query(Conversation).filter(
+        result = await db.execute(select(Conversation).where(
             Conversation.id == conversation_id, 
             Conversation.user_id == current_user.id
-        ).first()
+        ))
+        conversation = result.scalars().first()
         
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Удаляем беседу из Dify если она там есть
+        # Удаление в Dify ставим в outbox в той же транзакции - его выполнит фоновый воркер
         if conversation.dify_conversation_id:
-            try:
-                await dify_service.delete_conversation(
-                    conversation.dify_conversation_id, 
-                    current_user.username
-                )
-            except Exception as e:
-                print(f"Warning: Failed to delete from Dify: {str(e)}")
-                # Не прерываем процесс, если не удалось удалить из Dify
+            await enqueue_conversation_deletions(db, [
+                (conversation.dify_conversation_id, current_user.username)
+            ])
         
         # Удаляем сообщения сначала
-        db.query(Message).filter(Message.conversation_id == conversation.id).delete()
+        await db.execute(delete(Message).where(Message.conversation_id == conversation.id))
         
         # Удаляем беседу
-        db.delete(conversation)
-        db.commit()
+        await db.delete(conversation)
+        await db.commit()
+        notify_outbox_worker()
         
         return {"success": True, "message": "Conversation deleted successfully"}
     except Exception as e:
-        print(f"Error deleting conversation: {str(e)}")
+        logger.exception("Error deleting conversation")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/conversations/bulk-delete")
+async def bulk_delete_conversations(
+    delete_data: BulkDeleteRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if not delete_data.conversation_ids and not delete_data.older_than:
+        raise HTTPException(status_code=400, detail="Provide conversation_ids or older_than")
+
+    try:
+        filters = [Conversation.user_id == current_user.id]
+        if delete_data.conversation_ids:
+            filters.append(Conversation.id.in_(delete_data.conversation_ids))
+        if delete_data.older_than:
+            older_than = delete_data.older_than
+            if older_than.tzinfo is not None:
+                older_than = older_than.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            filters.append(Conversation.updated_at < older_than)
+
+        result = await db.execute(select(Conversation.id, Conversation.dify_conversation_id).where(*filters))
+        rows = result.all()
+        if not rows:
+            return {"success": True, "deleted": 0}
+
+        conversation_ids = [row.id for row in rows]
+        logger.info("Bulk deleting conversations", extra={"count": len(conversation_ids), "user": current_user.username})
+
+        # Одна транзакция: сообщения, беседы и задания на удаление в Dify
+        await db.execute(delete(Message).where(Message.conversation_id.in_(conversation_ids)))
+        await db.execute(delete(Conversation).where(
+            Conversation.id.in_(conversation_ids),
+            Conversation.user_id == current_user.id
+        ))
+        await enqueue_conversation_deletions(db, [
+            (row.dify_conversation_id, current_user.username)
+            for row in rows if row.dify_conversation_id
+        ])
+        await db.commit()
+
+        # Dify чистит фоновый воркер; неудачи остаются в dify_outbox для повтора
+        notify_outbox_worker()
+
+        return {"success": True, "deleted": len(conversation_ids)}
+    except Exception as e:
+        logger.exception("Error bulk deleting conversations")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/conversations/{conversation_id}")
@@ -252,31 +635,30 @@ async def rename_conversation(
     conversation_id: int,
     rename_data: RenameConversationRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        conversation = db.query(Conversation).filter(
+        result = await db.execute(select(Conversation).where(
             Conversation.id == conversation_id, 
             Conversation.user_id == current_user.id
-        ).first()
+        ))
+        conversation = result.scalars().first()
         
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Переименовываем в Dify если беседа там есть
+        # Переименование в Dify ставим в outbox, если беседа там есть
         if conversation.dify_conversation_id:
-            try:
-                await dify_service.rename_conversation(
-                    conversation.dify_conversation_id, 
-                    current_user.username, 
-                    rename_data.name
-                )
-            except Exception as e:
-                print(f"Warning: Failed to rename in Dify: {str(e)}")
-                # Продолжаем, даже если не удалось переименовать в Dify
+            await enqueue_conversation_rename(
+                db,
+                conversation.dify_conversation_id, 
+                current_user.username, 
+                rename_data.name
+            )
         
         conversation.name = rename_data.name
-        db.commit()
+        await db.commit()
+        notify_outbox_worker()
         
         return {
             "success": True, 
@@ -285,5 +667,5 @@ async def rename_conversation(
             "updated_at": safe_isoformat(conversation.updated_at)
         }
     except Exception as e:
-        print(f"Error renaming conversation: {str(e)}")
+        logger.exception("Error renaming conversation")
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
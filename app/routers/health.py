@@ -0,0 +1,22 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from fastapi import status
+
+from services.health import readiness
+
+router = APIRouter(tags=["health"])
+
+@router.get("/health/live")
+async def liveness():
+    """The process is up and the event loop answers; no dependencies are touched"""
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+async def readiness_check():
+    """Whether this instance can serve traffic: DB and Dify probes with per-dependency timings"""
+    result = await readiness()
+    ready = result.pop("ready")
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=result
+    )
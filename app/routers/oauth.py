@@ -1,20 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
 from fastapi.responses import RedirectResponse, JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
+import logging
 
 from database import get_db
-from services.auth_service import create_access_token, get_current_user
-from services.oauth_service import GoogleOAuth, create_or_get_oauth_user
+from services.auth_service import create_access_token, get_current_user, invalidate_cached_user
+from services.oauth_service import google_oauth, create_or_get_oauth_user
 from config import settings
 from models.models import User
 
 oauth_router = APIRouter(tags=["oauth"])
+logger = logging.getLogger(__name__)
 
 @oauth_router.get("/auth/google")
 async def google_auth(request: Request):
     """Initiate Google OAuth flow"""
-    google_oauth = GoogleOAuth()
     auth_url, state = google_oauth.get_auth_url()
     return RedirectResponse(url=auth_url)
 
@@ -23,7 +25,7 @@ async def google_callback(
     code: str = None,
     state: str = None,
     error: str = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Handle Google OAuth callback"""
     
@@ -38,18 +40,21 @@ async def google_callback(
     if not code:
         return RedirectResponse(url=f"{frontend_url}/login?error=oauth_failed")
     
-    google_oauth = GoogleOAuth()
-    
     try:
         token_data = await google_oauth.exchange_code_for_token(code)
         if not token_data:
             return RedirectResponse(url=f"{frontend_url}/login?error=oauth_failed")
         
-        user_info = await google_oauth.get_user_info(token_data["access_token"])
+        # ID token проверяем локально по кэшированному JWKS; userinfo - только запасной путь
+        user_info = None
+        if token_data.get("id_token"):
+            user_info = await google_oauth.verify_id_token(token_data["id_token"], token_data.get("access_token"))
+        if not user_info:
+            user_info = await google_oauth.get_user_info(token_data["access_token"])
         if not user_info:
             return RedirectResponse(url=f"{frontend_url}/login?error=oauth_failed")
         
-        user = create_or_get_oauth_user(db, user_info, "google")
+        user = await create_or_get_oauth_user(db, user_info, "google")
         
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
@@ -75,18 +80,19 @@ async def google_callback(
         
         return response
         
-    except Exception as e:
-        print(f"OAuth error: {str(e)}")
+    except Exception:
+        logger.exception("OAuth error")
         return RedirectResponse(url=f"{frontend_url}/login?error=oauth_failed")
 
 @oauth_router.post("/auth/unlink-google")
 async def unlink_google_account(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Unlink Google account from user profile"""
     
-    user = db.query(User).filter(User.email == current_user.email).first()
+    result = await db.execute(select(User).where(User.email == current_user.email))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -101,7 +107,8 @@ async def unlink_google_account(
     if user.oauth_provider == "google":
         user.oauth_provider = None
     
-    db.commit()
+    await db.commit()
+    invalidate_cached_user(user.email)
     
     return {"message": "Google account unlinked successfully"}
 
@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import re
+import unicodedata
+from typing import Optional
+from config import settings
+from services.cache import TTLCache
+from services.metrics import answer_cache_requests_total
+
+logger = logging.getLogger(__name__)
+
+def normalize_query(query: str) -> str:
+    """Fold case, unicode forms, whitespace and trailing punctuation so near-identical questions match"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip(" ?!.")
+
+class AnswerCacheBackend:
+    """
+    Storage interface for cached answers; shared backends implement the same two methods
+    """
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, answer: str, ttl: float):
+        raise NotImplementedError
+
+class InMemoryAnswerCacheBackend(AnswerCacheBackend):
+    """Per-process LRU with TTL"""
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, answer: str, ttl: float):
+        self._cache.set(key, answer, ttl=ttl)
+
+class RedisAnswerCacheBackend(AnswerCacheBackend):
+    """
+    Shared across workers; size is bounded by the Redis maxmemory/LRU policy.
+    Needs the optional `redis` package.
+    """
+    def __init__(self, url: str, prefix: str = "answer-cache:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("ANSWER_CACHE_BACKEND=redis requires the 'redis' package")
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(self._prefix + key)
+
+    async def set(self, key: str, answer: str, ttl: float):
+        await self._redis.set(self._prefix + key, answer, ex=max(1, int(ttl)))
+
+class AnswerCache:
+    """
+    Opt-in cache of first-turn Dify answers keyed by the normalized question and Dify app
+    """
+    def __init__(self, backend: AnswerCacheBackend, ttl: float, enabled: bool = True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+
+    def make_key(self, query: str, api_key: str, base_url: str) -> str:
+        # Ключ API не храним в открытом виде, только как часть хэша
+        raw = "\0".join([base_url, api_key, normalize_query(query)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get_answer(self, query: str, api_key: str, base_url: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            answer = await self.backend.get(self.make_key(query, api_key, base_url))
+        except Exception as e:
+            # Кэш не должен ломать чат: при ошибке бэкенда идем в Dify
+            answer_cache_requests_total.inc(result="error")
+            logger.warning("Answer cache read failed", extra={"error": str(e)})
+            return None
+        answer_cache_requests_total.inc(result="miss" if answer is None else "hit")
+        return answer
+
+    async def store_answer(self, query: str, api_key: str, base_url: str, answer: str):
+        if not self.enabled or not answer:
+            return
+        try:
+            await self.backend.set(self.make_key(query, api_key, base_url), answer, self.ttl)
+        except Exception as e:
+            answer_cache_requests_total.inc(result="error")
+            logger.warning("Answer cache write failed", extra={"error": str(e)})
+
+def create_answer_cache() -> AnswerCache:
+    if settings.ANSWER_CACHE_BACKEND == "redis":
+        backend = RedisAnswerCacheBackend(settings.ANSWER_CACHE_REDIS_URL)
+    else:
+        backend = InMemoryAnswerCacheBackend(maxsize=settings.ANSWER_CACHE_SIZE, ttl=settings.ANSWER_CACHE_TTL)
+    return AnswerCache(backend, ttl=settings.ANSWER_CACHE_TTL, enabled=settings.ANSWER_CACHE_ENABLED)
+
+answer_cache = create_answer_cache()
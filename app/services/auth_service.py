@@ -1,34 +1,74 @@
+import asyncio
 import secrets
 import hashlib
-import smtplib
 import random
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from config import settings
 from models.models import User, PasswordResetToken, EmailVerificationToken
 from database import get_db
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from services.cache import TTLCache
+from services.mail_service import mail_dispatcher
+from services.metrics import registry
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# Снимки пользователей по subject токена (email), чтобы не ходить в БД на каждый запрос
+user_cache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
 
-def get_password_hash(password) -> str:
-    return pwd_context.hash(password)
+# bcrypt отпускает GIL, поэтому хватает отдельного пула потоков вне event loop
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    thread_name_prefix="password-hash"
+)
+password_hash_slots = asyncio.Semaphore(settings.PASSWORD_HASH_MAX_CONCURRENCY)
+password_hash_rejected_total = registry.counter(
+    "password_hash_rejected_total", "Authentication requests shed with 503 because the hashing pool was saturated"
+)
+password_hash_in_flight = registry.gauge(
+    "password_hash_in_flight", "bcrypt jobs queued or running in the hashing pool"
+)
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = db.query(User).filter(User.email == email).first()
+async def run_password_job(func, *args):
+    """Run a bcrypt call in the hashing pool, shedding load with 503 when the queue is full"""
+    try:
+        await asyncio.wait_for(password_hash_slots.acquire(), timeout=settings.PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        password_hash_rejected_total.inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please try again",
+            headers={"Retry-After": "1"},
+        )
+    password_hash_in_flight.inc()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_hash_executor, func, *args)
+    finally:
+        password_hash_in_flight.dec()
+        password_hash_slots.release()
+
+async def verify_password(plain_password, hashed_password) -> bool:
+    return await run_password_job(pwd_context.verify, plain_password, hashed_password)
+
+async def get_password_hash(password) -> str:
+    return await run_password_job(pwd_context.hash, password)
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    # Завершаем читающую транзакцию, чтобы не держать соединение из пула во время bcrypt
+    await db.commit()
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
@@ -42,7 +82,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -55,18 +95,29 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.email == email).first()
+    cached = user_cache.get(email)
+    if cached is not None:
+        # Отдаем новый несвязанный с сессией экземпляр, чтобы запросы не делили общий объект
+        return User(**cached)
+    user = await get_user_by_email(db, email)
     if user is None:
         raise credentials_exception
+    user_cache.set(email, {column.key: getattr(user, column.key) for column in User.__table__.columns})
     return user
 
+def invalidate_cached_user(email: str):
+    """Drop the cached principal after the user's record changes"""
+    if email:
+        user_cache.delete(email)
+
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
 
 # Password reset functions
 def generate_reset_token() -> str:
@@ -75,8 +126,8 @@ def generate_reset_token() -> str:
 def create_reset_token_hash(token: str) -> str:
     return hashlib.sha256(token.encode()).hexdigest()
 
-def create_password_reset_token(db: Session, email: str):
-    db.query(PasswordResetToken).filter(PasswordResetToken.email == email).delete()
+async def create_password_reset_token(db: AsyncSession, email: str):
+    await db.execute(delete(PasswordResetToken).where(PasswordResetToken.email == email))
     
     token = generate_reset_token()
     token_hash = create_reset_token_hash(token)
@@ -89,40 +140,44 @@ def create_password_reset_token(db: Session, email: str):
     )
     
     db.add(db_token)
-    db.commit()
+    await db.commit()
     
     return token
 
-def get_reset_token(db: Session, token: str):
+async def get_reset_token(db: AsyncSession, token: str):
     token_hash = create_reset_token_hash(token)
     
-    return db.query(PasswordResetToken).filter(
+    result = await db.execute(select(PasswordResetToken).where(
         PasswordResetToken.token == token_hash,
         PasswordResetToken.used == False,
         PasswordResetToken.expires_at > datetime.utcnow()
-    ).first()
+    ))
+    return result.scalars().first()
 
-def update_user_password(db: Session, email: str, new_password: str):
-    user = get_user_by_email(db, email)
+async def update_user_password(db: AsyncSession, email: str, new_password: str):
+    user = await get_user_by_email(db, email)
     if user:
-        user.hashed_password = get_password_hash(new_password)
-        db.commit()
+        # Как в authenticate_user: соединение из пула не держим на время bcrypt
+        await db.commit()
+        user.hashed_password = await get_password_hash(new_password)
+        await db.commit()
+        invalidate_cached_user(email)
         return user
     return None
 
-def use_reset_token(db: Session, token_record: PasswordResetToken):
+async def use_reset_token(db: AsyncSession, token_record: PasswordResetToken):
     token_record.used = True
-    db.commit()
+    await db.commit()
 
 # Email verification functions
 def generate_verification_code() -> str:
     """Generate a 6-digit verification code"""
     return str(random.randint(100000, 999999))
 
-def create_email_verification_token(db: Session, email: str):
+async def create_email_verification_token(db: AsyncSession, email: str):
     """Create email verification token with 6-digit code"""
     # Delete any existing verification tokens for this email
-    db.query(EmailVerificationToken).filter(EmailVerificationToken.email == email).delete()
+    await db.execute(delete(EmailVerificationToken).where(EmailVerificationToken.email == email))
     
     verification_code = generate_verification_code()
     expires_at = datetime.utcnow() + timedelta(minutes=15)  # 15 minutes expiry
@@ -134,57 +189,41 @@ def create_email_verification_token(db: Session, email: str):
     )
     
     db.add(db_token)
-    db.commit()
+    await db.commit()
     
     return verification_code
 
-def get_verification_token(db: Session, email: str, code: str):
+async def get_verification_token(db: AsyncSession, email: str, code: str):
     """Get valid verification token"""
-    return db.query(EmailVerificationToken).filter(
+    result = await db.execute(select(EmailVerificationToken).where(
         EmailVerificationToken.email == email,
         EmailVerificationToken.code == code,
         EmailVerificationToken.used == False,
         EmailVerificationToken.expires_at > datetime.utcnow()
-    ).first()
+    ))
+    return result.scalars().first()
 
-def use_verification_token(db: Session, token_record: EmailVerificationToken):
+async def use_verification_token(db: AsyncSession, token_record: EmailVerificationToken):
     """Mark verification token as used"""
     token_record.used = True
-    db.commit()
+    await db.commit()
 
-def verify_user_email(db: Session, email: str):
+async def verify_user_email(db: AsyncSession, email: str):
     """Mark user's email as verified"""
-    user = get_user_by_email(db, email)
+    user = await get_user_by_email(db, email)
     if user:
         user.email_verified = True
-        db.commit()
+        await db.commit()
+        invalidate_cached_user(email)
         return user
     return None
 
 # Email sending functions
-def send_email(to_email: str, subject: str, body: str):
-    """Send email using SMTP"""
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = settings.FROM_EMAIL
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
-        server.starttls()
-        server.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(settings.FROM_EMAIL, to_email, text)
-        server.quit()
-        
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-        return False
+async def send_email(to_email: str, subject: str, body: str):
+    """Queue an email on the pooled SMTP dispatcher"""
+    return await mail_dispatcher.enqueue(to_email, subject, body)
 
-def send_verification_email(verification_code: str, email: str):
+async def send_verification_email(verification_code: str, email: str):
     """Send email verification code"""
     subject = "Email Verification Code - AI Legal Assistant"
     
@@ -201,9 +240,9 @@ def send_verification_email(verification_code: str, email: str):
     </html>
     """
     
-    return send_email(email, subject, body)
+    return await send_email(email, subject, body)
 
-def send_password_reset_email(reset_token: str, email: str):
+async def send_password_reset_email(reset_token: str, email: str):
     """Send password reset email"""
     reset_link = f"http://localhost:5173/reset-password?token={reset_token}"
     
@@ -221,4 +260,4 @@ def send_password_reset_email(reset_token: str, email: str):
     </html>
     """
     
-    return send_email(email, subject, body)
\ No newline at end of file
+    return await send_email(email, subject, body)
\ No newline at end of file
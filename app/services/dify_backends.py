@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Iterable, List, Optional, Tuple
+import aiohttp
+from config import settings
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+CIRCUIT_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Ответы шлюза перед Dify: запрос до узла не дошел, его можно повторить на другом
+FAILOVER_STATUSES = (502, 503, 504)
+
+dify_circuit_opened_total = registry.counter(
+    "dify_circuit_opened_total", "Times a Dify backend circuit breaker opened", ("backend",)
+)
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker. After failure_threshold failures in a row the backend
+    is skipped for reset_timeout seconds; then a single probe request decides
+    whether the circuit closes again or stays open for another period.
+    """
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def available(self) -> bool:
+        """Whether a request would be let through right now (does not reserve the probe)"""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self._probe_in_flight)
+
+    def allow_request(self) -> bool:
+        if not self.available():
+            return False
+        if self._state == HALF_OPEN:
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self._state = CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if this failure opened the circuit"""
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+            opened = self._state != OPEN
+            self._state = OPEN
+            self._opened_at = self._clock()
+            return opened
+        return False
+
+    def release(self):
+        """The request was abandoned (e.g. a cancelled hedge) without an outcome"""
+        self._probe_in_flight = False
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Errors that say something about the backend's health rather than about the request"""
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+def can_failover(error: BaseException) -> bool:
+    """Errors after which the request can safely be repeated on another backend"""
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    return getattr(error, "status", None) in FAILOVER_STATUSES
+
+class DifyBackend:
+    """
+    One Dify node: base URL, weight, breaker and the load estimate used for balancing
+    """
+    def __init__(self, base_url: str, weight: float, breaker: CircuitBreaker):
+        self.base_url = base_url.rstrip("/")
+        self.weight = weight
+        self.breaker = breaker
+        self.in_flight = 0
+        # Скользящее среднее задержки успешных вызовов, секунды
+        self.latency: Optional[float] = None
+
+    def load(self) -> float:
+        """Expected wait on this node: requests in flight times typical latency"""
+        return (self.in_flight + 1) * max(self.latency or 0.0, 0.001)
+
+    def record(self, elapsed: float, error: Optional[BaseException]):
+        """Feed the outcome of one call into the breaker and the latency estimate"""
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            self.breaker.release()
+            return
+        if error is not None and is_backend_failure(error):
+            self.record_failure(str(error) or type(error).__name__)
+            return
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        if elapsed > settings.DIFY_BREAKER_SLOW_CALL_SECONDS:
+            # Всплеск задержки считаем отказом, даже если ответ пришел
+            self.record_failure(f"slow call: {elapsed:.1f}s")
+        else:
+            self.breaker.record_success()
+
+    def record_failure(self, reason: str):
+        if self.breaker.record_failure():
+            dify_circuit_opened_total.inc(backend=self.base_url)
+            logger.warning("Dify backend circuit opened", extra={"backend": self.base_url, "reason": reason})
+
+def parse_backends(spec: str, default_url: str) -> List[Tuple[str, float]]:
+    """
+    Parse "base_url=weight" entries separated by ";", e.g.
+    "http://dify-1/v1=2;http://dify-2/v1=1". The weight is optional (1 by default);
+    an empty spec means the single default_url backend.
+    """
+    backends = []
+    for entry in spec.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, weight = entry, 1.0
+        if "=" in entry:
+            url, _, raw_weight = entry.rpartition("=")
+            try:
+                weight = float(raw_weight)
+            except ValueError:
+                raise ValueError(f"Invalid DIFY_BACKENDS entry: {entry!r}")
+        if not url or weight <= 0:
+            raise ValueError(f"Invalid DIFY_BACKENDS entry: {entry!r}")
+        backends.append((url.strip(), weight))
+    return backends or [(default_url, 1.0)]
+
+class DifyBackendPool:
+    """
+    Weighted, health-aware choice between Dify nodes: backends with an open circuit
+    are skipped, and of two candidates drawn by weight the less loaded one wins
+    (power of two choices), so a slow node sheds traffic before its breaker trips.
+    """
+    def __init__(self, backends: Iterable[DifyBackend], rng: random.Random = None):
+        self.backends = list(backends)
+        self._rng = rng or random.Random()
+
+    @classmethod
+    def from_urls(cls, backends: Iterable[Tuple[str, float]]) -> "DifyBackendPool":
+        return cls(
+            DifyBackend(
+                url, weight,
+                CircuitBreaker(settings.DIFY_BREAKER_FAILURE_THRESHOLD, settings.DIFY_BREAKER_RESET_TIMEOUT)
+            )
+            for url, weight in backends
+        )
+
+    @classmethod
+    def from_settings(cls) -> "DifyBackendPool":
+        return cls.from_urls(parse_backends(settings.DIFY_BACKENDS, settings.DIFY_API_BASE_URL))
+
+    def pick(self, exclude: Iterable[DifyBackend] = ()) -> Optional[DifyBackend]:
+        """Reserve a backend for one call; None when every remaining circuit is open"""
+        excluded = set(exclude)
+        candidates = [b for b in self.backends if b not in excluded and b.breaker.available()]
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            chosen = candidates[0]
+        else:
+            first = self._rng.choices(candidates, weights=[b.weight for b in candidates])[0]
+            rest = [b for b in candidates if b is not first]
+            second = self._rng.choices(rest, weights=[b.weight for b in rest])[0]
+            chosen = first if first.load() <= second.load() else second
+        chosen.breaker.allow_request()
+        return chosen
+
+    def states(self):
+        return {(b.base_url,): CIRCUIT_STATE_VALUES[b.breaker.state] for b in self.backends}
+
+    def in_flight(self):
+        return {(b.base_url,): b.in_flight for b in self.backends}
@@ -0,0 +1,218 @@
+import asyncio
+import datetime
+import logging
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from database import SessionLocal
+from models.models import DifyOutbox
+from services.dify_service import dify_service, DifyAPIError
+from services.metrics import registry
+
+OPERATION_DELETE = "delete"
+OPERATION_RENAME = "rename"
+
+drain_lock = asyncio.Lock()
+outbox_wakeup = asyncio.Event()
+outbox_worker_task: Optional[asyncio.Task] = None
+
+logger = logging.getLogger(__name__)
+
+dify_outbox_dead_letters_total = registry.counter(
+    "dify_outbox_dead_letters_total",
+    "Dify outbox rows left in the table after DIFY_OUTBOX_MAX_ATTEMPTS failed attempts", ("operation",)
+)
+
+async def enqueue_conversation_deletions(db: AsyncSession, conversations: Iterable[Tuple[str, str]]):
+    """
+    Queue Dify deletions as (dify_conversation_id, dify_user) pairs.
+    Rows are added to the caller's transaction, so they are committed together
+    with the local delete and survive a crash before Dify is reached.
+    """
+    conversations = list(conversations)
+    if not conversations:
+        return
+    # Удаление делает ожидающие переименования бессмысленными
+    await db.execute(delete(DifyOutbox).where(
+        DifyOutbox.operation == OPERATION_RENAME,
+        DifyOutbox.dify_conversation_id.in_([dify_id for dify_id, _ in conversations])
+    ))
+    now = datetime.datetime.utcnow()
+    db.add_all([
+        DifyOutbox(
+            operation=OPERATION_DELETE,
+            dify_conversation_id=dify_conversation_id,
+            dify_user=dify_user,
+            next_attempt_at=now
+        )
+        for dify_conversation_id, dify_user in conversations
+    ])
+
+async def enqueue_conversation_rename(db: AsyncSession, dify_conversation_id: str, dify_user: str, name: str):
+    """
+    Queue a Dify rename in the caller's transaction, superseding older pending renames
+    """
+    await db.execute(delete(DifyOutbox).where(
+        DifyOutbox.operation == OPERATION_RENAME,
+        DifyOutbox.dify_conversation_id == dify_conversation_id
+    ))
+    db.add(DifyOutbox(
+        operation=OPERATION_RENAME,
+        dify_conversation_id=dify_conversation_id,
+        dify_user=dify_user,
+        name=name,
+        next_attempt_at=datetime.datetime.utcnow()
+    ))
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    """Exponential backoff for the next attempt"""
+    seconds = min(settings.DIFY_OUTBOX_BACKOFF_BASE * (2 ** attempts), settings.DIFY_OUTBOX_BACKOFF_MAX)
+    return datetime.timedelta(seconds=seconds)
+
+async def claim_due_entries(db: AsyncSession, limit: int):
+    """
+    Lease due entries so that concurrent drains (other workers) skip them
+    """
+    now = datetime.datetime.utcnow()
+    result = await db.execute(
+        select(DifyOutbox)
+        .where(
+            DifyOutbox.next_attempt_at <= now,
+            DifyOutbox.attempts < settings.DIFY_OUTBOX_MAX_ATTEMPTS
+        )
+        .order_by(DifyOutbox.next_attempt_at, DifyOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    entries = result.scalars().all()
+    if entries:
+        lease_until = now + datetime.timedelta(seconds=settings.DIFY_REQUEST_TIMEOUT * 2)
+        await db.execute(
+            update(DifyOutbox)
+            .where(DifyOutbox.id.in_([entry.id for entry in entries]))
+            .values(next_attempt_at=lease_until)
+        )
+    await db.commit()
+    return entries
+
+def coalesce_entries(entries: List[DifyOutbox]) -> List[Tuple[DifyOutbox, List[DifyOutbox]]]:
+    """
+    Collapse a batch to one effective operation per Dify conversation:
+    a delete wins over renames, otherwise the latest rename wins.
+    Returns (entry to apply, all entries it settles) pairs.
+    """
+    by_conversation = {}
+    for entry in entries:
+        by_conversation.setdefault(entry.dify_conversation_id, []).append(entry)
+
+    plan = []
+    for group in by_conversation.values():
+        deletes = [entry for entry in group if entry.operation == OPERATION_DELETE]
+        effective = deletes[0] if deletes else max(group, key=lambda entry: entry.id)
+        plan.append((effective, group))
+    return plan
+
+async def apply_entry(entry: DifyOutbox, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        try:
+            if entry.operation == OPERATION_DELETE:
+                await dify_service.delete_conversation(entry.dify_conversation_id, entry.dify_user)
+            elif entry.operation == OPERATION_RENAME:
+                await dify_service.rename_conversation(entry.dify_conversation_id, entry.dify_user, entry.name)
+            else:
+                raise ValueError(f"Unknown outbox operation: {entry.operation}")
+        except DifyAPIError as e:
+            # Беседы уже нет в Dify: удаление достигло цели, переименовывать нечего
+            if e.status != 404:
+                raise
+
+async def drain_dify_outbox() -> int:
+    """
+    Apply due outbox entries concurrently (bounded by DIFY_CLEANUP_CONCURRENCY).
+    Successful entries are removed, failed ones are rescheduled with backoff.
+    After DIFY_OUTBOX_MAX_ATTEMPTS failures the rows stay in the table as dead
+    letters (with last_error) and are no longer claimed.
+    Returns the number of entries settled.
+    """
+    if drain_lock.locked():
+        # Уже идет обработка в этом процессе - новые записи она подберет сама
+        return 0
+
+    applied = 0
+    async with drain_lock:
+        semaphore = asyncio.Semaphore(settings.DIFY_CLEANUP_CONCURRENCY)
+        async with SessionLocal() as db:
+            while True:
+                entries = await claim_due_entries(db, settings.DIFY_OUTBOX_BATCH_SIZE)
+                if not entries:
+                    break
+
+                plan = coalesce_entries(entries)
+                results = await asyncio.gather(
+                    *(apply_entry(effective, semaphore) for effective, _ in plan),
+                    return_exceptions=True
+                )
+
+                done_ids = []
+                now = datetime.datetime.utcnow()
+                for (effective, group), outcome in zip(plan, results):
+                    # CancelledError тоже неудача: запись нельзя удалять, операция не выполнена
+                    if isinstance(outcome, BaseException):
+                        attempts = effective.attempts + 1
+                        error = str(outcome) or type(outcome).__name__
+                        logger.warning("Dify outbox operation failed", extra={"operation": effective.operation, "dify_conversation_id": effective.dify_conversation_id, "attempts": attempts, "error": error})
+                        if attempts >= settings.DIFY_OUTBOX_MAX_ATTEMPTS:
+                            dify_outbox_dead_letters_total.inc(len(group), operation=effective.operation)
+                            logger.error("Dify outbox operation gave up", extra={"operation": effective.operation, "dify_conversation_id": effective.dify_conversation_id, "attempts": attempts, "error": error})
+                        await db.execute(
+                            update(DifyOutbox)
+                            .where(DifyOutbox.id.in_([entry.id for entry in group]))
+                            .values(
+                                attempts=attempts,
+                                next_attempt_at=now + retry_delay(effective.attempts),
+                                last_error=error
+                            )
+                        )
+                    else:
+                        done_ids.extend(entry.id for entry in group)
+
+                if done_ids:
+                    await db.execute(delete(DifyOutbox).where(DifyOutbox.id.in_(done_ids)))
+                await db.commit()
+                # Неудачные записи получили next_attempt_at в будущем и в этом проходе не вернутся
+                applied += len(done_ids)
+    return applied
+
+def notify_outbox_worker():
+    """Wake the worker right away instead of waiting for the next poll"""
+    outbox_wakeup.set()
+
+async def run_outbox_worker():
+    while True:
+        outbox_wakeup.clear()
+        try:
+            await drain_dify_outbox()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error draining Dify outbox")
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=settings.DIFY_OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_outbox_worker():
+    global outbox_worker_task
+    if outbox_worker_task is None or outbox_worker_task.done():
+        outbox_worker_task = asyncio.create_task(run_outbox_worker())
+
+async def stop_outbox_worker():
+    global outbox_worker_task
+    if outbox_worker_task is not None:
+        outbox_worker_task.cancel()
+        try:
+            await outbox_worker_task
+        except asyncio.CancelledError:
+            pass
+        outbox_worker_task = None
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+from config import settings
+from services.metrics import DIFY_BUCKETS, register_pool_gauge, registry
+
+dify_queue_wait_seconds = registry.histogram(
+    "dify_queue_wait_seconds", "Time a Dify generation waited for a scheduler slot", ("outcome",), buckets=DIFY_BUCKETS
+)
+dify_queue_rejected_total = registry.counter(
+    "dify_queue_rejected_total", "Dify generations rejected after waiting DIFY_MAX_QUEUE_WAIT for a slot"
+)
+
+class QueueTimeoutError(Exception):
+    """No generation slot became free within the maximum queue wait"""
+
+class FairScheduler:
+    """
+    Admission control for Dify generations: at most max_concurrency run at once
+    and at most per_user_limit per user. Waiting requests are queued per user and
+    slots are handed out round-robin across users, so one user with many parallel
+    questions cannot starve the others. Limits apply per worker process.
+    """
+    def __init__(self, max_concurrency: int, per_user_limit: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.per_user_limit = per_user_limit
+        self.max_wait = max_wait
+        self._active = 0
+        self._active_by_user: Dict[str, int] = {}
+        # Пользователи с ожидающими запросами в порядке очереди обхода
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    def active(self) -> int:
+        return self._active
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def _grant(self, user_id: str):
+        self._active += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + 1
+
+    def _release(self, user_id: str):
+        self._active -= 1
+        remaining = self._active_by_user[user_id] - 1
+        if remaining:
+            self._active_by_user[user_id] = remaining
+        else:
+            del self._active_by_user[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting users in round-robin order"""
+        while self._active < self.max_concurrency:
+            for user_id, queue in self._waiting.items():
+                if self._active_by_user.get(user_id, 0) < self.per_user_limit:
+                    break
+            else:
+                return
+            future = queue.popleft()
+            if queue:
+                # Пользователь уходит в конец очереди обхода
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            if not future.done():
+                self._grant(user_id)
+                future.set_result(None)
+
+    def _forget(self, user_id: str, future: asyncio.Future):
+        queue = self._waiting.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+        if not queue:
+            del self._waiting[user_id]
+
+    async def acquire(self, user_id: str):
+        """Wait for a slot; raises QueueTimeoutError after max_wait seconds"""
+        # Встаем в очередь всегда: свободный слот выдается в порядке обхода, без обгона ожидающих
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self._dispatch()
+        if future.done():
+            dify_queue_wait_seconds.observe(0, outcome="admitted")
+            return
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self._forget(user_id, future)
+            if not future.done():
+                future.cancel()
+                dify_queue_wait_seconds.observe(time.perf_counter() - started, outcome="rejected")
+                dify_queue_rejected_total.inc()
+                raise QueueTimeoutError("Too many requests are waiting for the assistant, please try again later")
+        except BaseException:
+            self._forget(user_id, future)
+            if future.done() and not future.cancelled():
+                # Слот выдали одновременно с отменой - возвращаем его
+                self._release(user_id)
+            else:
+                future.cancel()
+            raise
+        dify_queue_wait_seconds.observe(time.perf_counter() - started, outcome="admitted")
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+dify_scheduler = FairScheduler(
+    max_concurrency=settings.DIFY_MAX_CONCURRENT_GENERATIONS,
+    per_user_limit=settings.DIFY_MAX_GENERATIONS_PER_USER,
+    max_wait=settings.DIFY_MAX_QUEUE_WAIT,
+)
+
+register_pool_gauge("dify_generations_active", "Dify generations holding a scheduler slot", dify_scheduler.active)
+register_pool_gauge("dify_generations_queued", "Dify generations waiting for a scheduler slot", dify_scheduler.queued)
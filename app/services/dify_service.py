@@ -1,17 +1,245 @@
 import aiohttp
+import asyncio
+import contextlib
+import functools
+import inspect
 import json
-from typing import Dict, Any, Optional, List
+import logging
+import time
+from typing import Dict, Any, Optional, List, AsyncIterator, Awaitable, Callable
 from config import settings
+from services.answer_cache import normalize_query
+from services.dify_backends import DifyBackend, DifyBackendPool, can_failover
+from services.dify_scheduler import dify_scheduler
+from services.metrics import dify_request_duration_seconds, register_pool_gauge, registry
+
+logger = logging.getLogger(__name__)
+
+dify_coalesced_total = registry.counter(
+    "dify_coalesced_total", "First-turn questions answered by joining an identical in-flight Dify call"
+)
+dify_failovers_total = registry.counter(
+    "dify_failovers_total", "Dify calls repeated on another backend after a connect error or 502/503/504"
+)
+dify_hedges_total = registry.counter(
+    "dify_hedges_total", "Hedged Dify calls by which request answered first", ("winner",)
+)
+
+class DifyAPIError(Exception):
+    """Non-200 response from the Dify API"""
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+class DifyUnavailableError(DifyAPIError):
+    """Every Dify backend has an open circuit"""
+    def __init__(self):
+        super().__init__("No Dify backend is available", 503)
+
+def call_status(error: Optional[BaseException]) -> str:
+    """Status label for a finished Dify call"""
+    if error is None:
+        return "200"
+    if isinstance(error, DifyAPIError):
+        return str(error.status)
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return "cancelled"
+    return "error"
+
+def observe_dify_call(func):
+    """
+    Record latency and outcome of a DifyService method in dify_request_duration_seconds.
+    For streaming methods the time covers the whole stream.
+    """
+    method = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def stream_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = None
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                dify_request_duration_seconds.observe(time.perf_counter() - started, method=method, status=call_status(error))
+        return stream_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = None
+        try:
+            return await func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            dify_request_duration_seconds.observe(time.perf_counter() - started, method=method, status=call_status(error))
+    return wrapper
 
 class DifyService:
-    def __init__(self, api_key: str = settings.DIFY_API_KEY, base_url: str = settings.DIFY_API_BASE_URL):
+    """
+    Client for one Dify app served by one or more nodes (DIFY_BACKENDS).
+    The nodes must share Dify's database, since a conversation may continue on any of them.
+    An explicit base_url (without backends) pins the client to that single node.
+    """
+    def __init__(self, api_key: str = settings.DIFY_API_KEY, base_url: Optional[str] = None,
+                 backends: Optional[DifyBackendPool] = None):
         self.api_key = api_key
-        self.base_url = base_url
+        self.base_url = base_url or settings.DIFY_API_BASE_URL
+        if backends is None:
+            backends = DifyBackendPool.from_urls([(base_url, 1.0)]) if base_url else DifyBackendPool.from_settings()
+        self.backends = backends
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Нормализованный вопрос -> Future ответа ведущего запроса
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def start(self):
+        """
+        Open the shared HTTP session (called on application startup)
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=settings.DIFY_POOL_LIMIT,
+                limit_per_host=settings.DIFY_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=settings.DIFY_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=settings.DIFY_DNS_CACHE_TTL,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=settings.DIFY_REQUEST_TIMEOUT,
+                connect=settings.DIFY_CONNECT_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        """
+        Close the shared HTTP session (called on application shutdown)
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def connections_in_use(self) -> Optional[int]:
+        """Connections currently leased from the shared connector (None before startup)"""
+        if self._session is None or self._session.closed:
+            return None
+        return len(getattr(self._session.connector, "_acquired", ()))
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Return the shared session, opening it lazily if startup was skipped
+        """
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    def generation_slot(self, user_id: str):
+        """Fair-scheduler slot held for one generation (no-op with DIFY_SCHEDULER_ENABLED off)"""
+        if settings.DIFY_SCHEDULER_ENABLED:
+            return dify_scheduler.slot(user_id)
+        return contextlib.nullcontext()
+
+    def _pick_backend(self, tried: List[DifyBackend], last_error: Optional[Exception]) -> DifyBackend:
+        backend = self.backends.pick(exclude=tried)
+        if backend is None:
+            if last_error is not None:
+                raise last_error
+            raise DifyUnavailableError()
+        tried.append(backend)
+        return backend
+
+    async def _attempt(self, backend: DifyBackend, send: Callable[[DifyBackend], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        error = None
+        backend.in_flight += 1
+        try:
+            return await send(backend)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            backend.in_flight -= 1
+            backend.record(time.monotonic() - started, error)
+
+    async def _hedged(self, primary: DifyBackend, send: Callable[[DifyBackend], Awaitable[Any]],
+                      tried: List[DifyBackend]) -> Any:
+        """
+        Run send on the primary backend; if it has not answered after DIFY_HEDGE_DELAY,
+        race the same request on a second backend and return whichever succeeds first
+        """
+        tasks = {asyncio.ensure_future(self._attempt(primary, send)): "primary"}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=settings.DIFY_HEDGE_DELAY)
+            if done:
+                return next(iter(done)).result()
+            secondary = self.backends.pick(exclude=tried)
+            if secondary is None:
+                return await next(iter(tasks))
+            tried.append(secondary)
+            tasks[asyncio.ensure_future(self._attempt(secondary, send))] = "hedge"
 
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        dify_hedges_total.inc(winner=tasks[task])
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    # Проигравший запрос отменяем: его ответ уже не нужен
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    async def _call(self, send: Callable[[DifyBackend], Awaitable[Any]], hedge: bool = False) -> Any:
+        """
+        Run send(backend) on a backend chosen by the pool. Connect errors and 502/503/504
+        fail over to the remaining backends; with hedge, slow calls are raced on a second one.
+        """
+        tried: List[DifyBackend] = []
+        last_error = None
+        while True:
+            backend = self._pick_backend(tried, last_error)
+            try:
+                if hedge and len(self.backends.backends) > 1:
+                    return await self._hedged(backend, send, tried)
+                return await self._attempt(backend, send)
+            except Exception as e:
+                if not can_failover(e):
+                    raise
+                last_error = e
+                dify_failovers_total.inc()
+                logger.warning("Dify backend failed, trying another", extra={"backend": backend.base_url, "error": str(e)})
+
+    async def _request_json(self, method: str, path: str, error_message: str,
+                            json_body: Optional[Dict[str, Any]] = None, hedge: bool = False) -> Dict[str, Any]:
+        session = await self.get_session()
+
+        async def send(backend: DifyBackend):
+            async with session.request(method, f"{backend.base_url}{path}", headers=self.headers, json=json_body) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise DifyAPIError(f"{error_message}: {text}", response.status)
+                return await response.json()
+
+        return await self._call(send, hedge=hedge)
+
+    @observe_dify_call
     async def send_message(self, 
                          query: str, 
                          user_id: str, 
@@ -19,7 +247,8 @@ class DifyService:
                          inputs: Dict[str, Any] = None,
                          files: List[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
-        Send a message to Dify API
+        Send a message to Dify API. Does not take a generation slot: use
+        send_scheduled_message, so that queue wait stays out of the Dify latency metric
         """
         if inputs is None:
             inputs = {}
@@ -27,8 +256,6 @@ class DifyService:
         if files is None:
             files = []
             
-        url = f"{self.base_url}/chat-messages"
-        
         payload = {
             "query": query,
             "user": user_id,
@@ -42,38 +269,207 @@ class DifyService:
         if files:
             payload["files"] = files
             
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=self.headers, json=payload) as response:
-                if response.status != 200:
+        # Хеджируем только новые беседы: дубль в существующей попал бы в ее историю в Dify
+        return await self._request_json(
+            "POST", "/chat-messages", "Failed to send message", payload,
+            hedge=settings.DIFY_HEDGE_ENABLED and not conversation_id
+        )
+
+    async def send_scheduled_message(self, query: str, user_id: str,
+                                     conversation_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        send_message under a generation slot; raises QueueTimeoutError when none frees up in time
+        """
+        async with self.generation_slot(user_id):
+            return await self.send_message(query=query, user_id=user_id, conversation_id=conversation_id)
+
+    async def send_first_message(self, query: str, user_id: str) -> Dict[str, Any]:
+        """
+        Send the first message of a new conversation, coalescing identical in-flight questions.
+        The first caller admitted by the scheduler (leader) talks to Dify; callers asking the same normalized question
+        meanwhile await its answer and get it without Dify message/conversation ids,
+        so their conversations start in Dify on their next message, seeded with this answer.
+        """
+        if not settings.DIFY_SINGLE_FLIGHT_ENABLED:
+            return await self.send_scheduled_message(query=query, user_id=user_id)
+
+        key = normalize_query(query)
+        leader = self._in_flight.get(key)
+        if leader is None:
+            async with self.generation_slot(user_id):
+                # Ведущим становимся только со слотом: иначе чужие вопросы ждали бы в очереди этого пользователя
+                leader = self._in_flight.get(key)
+                if leader is None:
+                    return await self._lead_first_message(key, query, user_id)
+            # Пока ждали слот, такой же вопрос уже ушел в Dify - слот отдали, ждем его ответ
+
+        try:
+            # shield: отмена одного ведомого не должна отменять общий Future
+            result = await asyncio.shield(leader)
+        except Exception:
+            # Ведущий запрос упал - пробуем сами, а не тиражируем его ошибку
+            return await self.send_scheduled_message(query=query, user_id=user_id)
+        dify_coalesced_total.inc()
+        return {"answer": result["answer"], "message_id": None, "conversation_id": None}
+
+    async def _lead_first_message(self, key: str, query: str, user_id: str) -> Dict[str, Any]:
+        """Send the question as the single-flight leader; the caller holds its generation slot"""
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await self.send_message(query=query, user_id=user_id)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # Отмену ведущего ведомым передаем как обычную ошибку, чтобы они пошли в Dify сами
+            future.set_exception(e if isinstance(e, Exception) else DifyAPIError("Leader request was cancelled", 499))
+            # Помечаем исключение полученным, даже если ведомых не было
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    @observe_dify_call
+    async def stream_message(self,
+                             query: str,
+                             user_id: str,
+                             conversation_id: Optional[str] = None,
+                             inputs: Dict[str, Any] = None,
+                             files: List[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Send a message to Dify API in streaming mode and yield events as they arrive.
+        The caller holds generation_slot for the whole stream: it has to be taken
+        before the HTTP response starts, while a full queue can still be a 503.
+        """
+        if inputs is None:
+            inputs = {}
+
+        if files is None:
+            files = []
+
+        payload = {
+            "query": query,
+            "user": user_id,
+            "response_mode": "streaming",
+            "inputs": inputs
+        }
+
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+
+        if files:
+            payload["files"] = files
+
+        session = await self.get_session()
+        # Общий таймаут не ограничивает длинный стрим, только паузы между чанками
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=settings.DIFY_CONNECT_TIMEOUT,
+            sock_read=settings.DIFY_STREAM_READ_TIMEOUT,
+        )
+
+        async def open_stream(backend: DifyBackend):
+            response = await session.post(
+                f"{backend.base_url}/chat-messages", headers=self.headers, json=payload, timeout=timeout
+            )
+            if response.status != 200:
+                text = await response.text()
+                response.release()
+                raise DifyAPIError(f"Failed to send message: {text}", response.status)
+            return backend, response
+
+        # Переключение на другой узел возможно только до начала стрима
+        backend, response = await self._call(open_stream)
+        backend.in_flight += 1
+        try:
+            async with response:
+                # Dify шлет SSE: строки "data: {...}", события разделены пустой строкой
+                buffer = b""
+                async for chunk in response.content.iter_any():
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        event = self._parse_stream_line(line)
+                        if event is not None:
+                            yield event
+
+                event = self._parse_stream_line(buffer)
+                if event is not None:
+                    yield event
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            backend.record_failure(str(e) or type(e).__name__)
+            raise
+        finally:
+            backend.in_flight -= 1
+
+    @staticmethod
+    def _parse_stream_line(line: bytes) -> Optional[Dict[str, Any]]:
+        """
+        Parse a single SSE line from Dify into an event dict
+        """
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            return None
+        data = line[len(b"data:"):].strip()
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            return None
+
+    @observe_dify_call
+    async def ping(self, timeout: float) -> int:
+        """
+        Cheap reachability check: any HTTP answer below 500 means Dify is up.
+        All backends are probed at once and directly, past the circuit breakers:
+        a health check must neither close a circuit tripped by slow generations nor
+        take a half-open node's only probe. Returns the first successful status code,
+        raises the last error (DifyAPIError on 5xx) when no backend answers.
+        """
+        session = await self.get_session()
+
+        async def probe(backend: DifyBackend):
+            url = f"{backend.base_url}/parameters"
+            async with session.get(url, headers=self.headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status >= 500:
                     text = await response.text()
-                    raise Exception(f"Failed to send message: {text}")
-                return await response.json()
+                    raise DifyAPIError(f"Dify is unavailable: {text}", response.status)
+                return response.status
+
+        tasks = [asyncio.create_task(probe(backend)) for backend in self.backends.backends]
+        try:
+            last_error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as e:
+                    last_error = e
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
+    @observe_dify_call
     async def get_conversation_history(self, conversation_id: str, user_id: str, limit: int = 20) -> Dict[str, Any]:
         """
         Get conversation history
         """
-        url = f"{self.base_url}/messages?conversation_id={conversation_id}&user={user_id}&limit={limit}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                if response.status != 200:
-                    text = await response.text()
-                    raise Exception(f"Failed to get conversation history: {text}")
-                return await response.json()
+        return await self._request_json(
+            "GET", f"/messages?conversation_id={conversation_id}&user={user_id}&limit={limit}",
+            "Failed to get conversation history", hedge=settings.DIFY_HEDGE_ENABLED
+        )
 
+    @observe_dify_call
     async def get_conversations(self, user_id: str, limit: int = 20) -> Dict[str, Any]:
         """
         Get conversations for a user
         """
-        url = f"{self.base_url}/conversations?user={user_id}&limit={limit}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                if response.status != 200:
-                    text = await response.text()
-                    raise Exception(f"Failed to get conversations: {text}")
-                return await response.json()
+        return await self._request_json(
+            "GET", f"/conversations?user={user_id}&limit={limit}",
+            "Failed to get conversations", hedge=settings.DIFY_HEDGE_ENABLED
+        )
 
     async def create_new_conversation(self, name: str, user_id: str) -> Dict[str, Any]:
         """
@@ -85,6 +481,7 @@ class DifyService:
             "name": name
         }
     
+    @observe_dify_call
     async def rename_conversation(self, conversation_id: str, user_id: str, name: str = None) -> Dict[str, Any]:
         """
         Rename a conversation
@@ -93,8 +490,6 @@ class DifyService:
             # Если conversation_id еще нет (чат без сообщений), просто возвращаем успех
             return {"success": True}
             
-        url = f"{self.base_url}/conversations/{conversation_id}/name"
-        
         payload = {
             "user": user_id
         }
@@ -104,13 +499,11 @@ class DifyService:
         else:
             payload["auto_generate"] = True
             
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=self.headers, json=payload) as response:
-                if response.status != 200:
-                    text = await response.text()
-                    raise Exception(f"Failed to rename conversation: {text}")
-                return await response.json()
+        return await self._request_json(
+            "POST", f"/conversations/{conversation_id}/name", "Failed to rename conversation", payload
+        )
     
+    @observe_dify_call
     async def delete_conversation(self, conversation_id: str, user_id: str) -> Dict[str, Any]:
         """
         Delete a conversation
@@ -119,15 +512,23 @@ class DifyService:
             # Если conversation_id еще нет, просто возвращаем успех
             return {"success": True}
             
-        url = f"{self.base_url}/conversations/{conversation_id}"
-        
         payload = {
             "user": user_id
         }
             
-        async with aiohttp.ClientSession() as session:
-            async with session.delete(url, headers=self.headers, json=payload) as response:
-                if response.status != 200:
-                    text = await response.text()
-                    raise Exception(f"Failed to delete conversation: {text}")
-                return await response.json()
\ No newline at end of file
+        return await self._request_json(
+            "DELETE", f"/conversations/{conversation_id}", "Failed to delete conversation", payload
+        )
+
+# Общий экземпляр: сессия открывается и закрывается в lifespan приложения
+dify_service = DifyService()
+
+register_pool_gauge("dify_pool_limit", "Connection limit of the shared Dify HTTP connector", lambda: settings.DIFY_POOL_LIMIT)
+register_pool_gauge("dify_pool_in_use", "Dify HTTP connections currently in use", dify_service.connections_in_use)
+registry.gauge(
+    "dify_backend_circuit_state", "Dify backend circuit breaker state (0 closed, 1 half-open, 2 open)",
+    ("backend",), callback=dify_service.backends.states
+)
+registry.gauge(
+    "dify_backend_in_flight", "Dify calls in flight per backend", ("backend",), callback=dify_service.backends.in_flight
+)
@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from sqlalchemy import text
+from config import settings
+from database import engine
+from services.dify_service import dify_service
+
+logger = logging.getLogger(__name__)
+
+class CachedProbe:
+    """
+    Dependency check whose result is reused for `ttl` seconds.
+    Concurrent callers during a refresh wait for the same probe instead of starting their own.
+    """
+    def __init__(self, name: str, check: Callable[[], Awaitable[Optional[dict]]], ttl: float, timeout: float):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.timeout = timeout
+        self._result: Optional[dict] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def run(self) -> dict:
+        if self._result is not None and time.monotonic() < self._expires_at:
+            return {**self._result, "cached": True}
+
+        async with self._lock:
+            # Пока ждали блокировку, другой запрос мог уже обновить результат
+            if self._result is not None and time.monotonic() < self._expires_at:
+                return {**self._result, "cached": True}
+
+            started = time.perf_counter()
+            result = {"status": "up"}
+            try:
+                details = await asyncio.wait_for(self.check(), timeout=self.timeout)
+                if details:
+                    result.update(details)
+            except asyncio.TimeoutError:
+                result = {"status": "down", "error": f"timed out after {self.timeout:g}s"}
+            except Exception as e:
+                result = {"status": "down", "error": str(e)}
+            result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            result["checked_at"] = datetime.datetime.utcnow().isoformat()
+
+            if result["status"] != "up":
+                logger.warning("Health probe failed", extra={"dependency": self.name, "error": result.get("error")})
+            self._result = result
+            self._expires_at = time.monotonic() + self.ttl
+            return {**result, "cached": False}
+
+async def check_database() -> dict:
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    pool = engine.sync_engine.pool
+    checked_out = getattr(pool, "checkedout", None)
+    return {"pool_checked_out": checked_out()} if callable(checked_out) else {}
+
+async def check_dify() -> dict:
+    return {"http_status": await dify_service.ping(timeout=settings.HEALTH_PROBE_TIMEOUT)}
+
+database_probe = CachedProbe("database", check_database, settings.HEALTH_CACHE_TTL, settings.HEALTH_PROBE_TIMEOUT)
+dify_probe = CachedProbe("dify", check_dify, settings.HEALTH_CACHE_TTL, settings.HEALTH_PROBE_TIMEOUT)
+
+async def readiness() -> Dict[str, object]:
+    """
+    Run all probes concurrently. The database is always required;
+    Dify only when HEALTH_DIFY_REQUIRED, otherwise its outage reports "degraded".
+    """
+    database, dify = await asyncio.gather(database_probe.run(), dify_probe.run())
+    dify["required"] = settings.HEALTH_DIFY_REQUIRED
+
+    ready = database["status"] == "up" and (dify["status"] == "up" or not settings.HEALTH_DIFY_REQUIRED)
+    if not ready:
+        status = "not_ready"
+    elif dify["status"] != "up":
+        status = "degraded"
+    else:
+        status = "ready"
+    return {
+        "ready": ready,
+        "status": status,
+        "checks": {"database": database, "dify": dify}
+    }
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from typing import List, Optional
+from config import settings
+from services.metrics import register_pool_gauge
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class OutgoingMail:
+    to_email: str
+    subject: str
+    body: str
+    attempts: int = 0
+
+class MailDispatcher:
+    """
+    Queue-based mail sender that keeps one authenticated SMTP connection open,
+    sends queued messages in batches over it, rate-limits and retries with backoff.
+    smtplib is blocking, so all SMTP I/O runs on a single dedicated thread.
+    """
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        self._worker: Optional[asyncio.Task] = None
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self._next_send_at = 0.0
+        self.sent = 0
+        self.failed = 0
+
+    async def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=settings.SMTP_QUEUE_SIZE)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Flush what is queued (bounded by timeout), then close the connection"""
+        if self._worker is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Emails left unsent on shutdown", extra={"count": self.queue.qsize()})
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._disconnect)
+
+    async def enqueue(self, to_email: str, subject: str, body: str) -> bool:
+        await self.start()
+        try:
+            self.queue.put_nowait(OutgoingMail(to_email, subject, body))
+            return True
+        except asyncio.QueueFull:
+            self.failed += 1
+            logger.error("Mail queue is full, dropping message", extra={"to_email": to_email})
+            return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                first = await asyncio.wait_for(self.queue.get(), timeout=settings.SMTP_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Сервер все равно закроет простаивающее соединение - закрываем сами
+                await loop.run_in_executor(self._executor, self._disconnect)
+                continue
+
+            batch = [first]
+            while len(batch) < settings.SMTP_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                failures = await loop.run_in_executor(self._executor, self._send_batch, batch)
+            except Exception as e:
+                failures = [(mail, e) for mail in batch]
+
+            for mail, error in failures:
+                self._schedule_retry(mail, error)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _schedule_retry(self, mail: OutgoingMail, error: Exception):
+        mail.attempts += 1
+        if mail.attempts > settings.SMTP_MAX_RETRIES:
+            self.failed += 1
+            logger.error("Failed to send email", extra={"to_email": mail.to_email, "attempts": mail.attempts, "error": str(error)})
+            return
+        delay = settings.SMTP_RETRY_BACKOFF * (2 ** (mail.attempts - 1))
+        logger.warning("Retrying email", extra={"to_email": mail.to_email, "delay": delay, "error": str(error)})
+        asyncio.get_running_loop().call_later(delay, self._requeue, mail)
+
+    def _requeue(self, mail: OutgoingMail):
+        try:
+            self.queue.put_nowait(mail)
+        except asyncio.QueueFull:
+            self.failed += 1
+            logger.error("Mail queue is full, dropping retry", extra={"to_email": mail.to_email})
+
+    # Дальше - только в SMTP-потоке
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT)
+        if settings.SMTP_USE_TLS:
+            smtp.starttls()
+        if settings.SMTP_USERNAME:
+            smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+        return smtp
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _get_connection(self) -> smtplib.SMTP:
+        if self._smtp is not None and time.monotonic() - self._last_used > settings.SMTP_IDLE_TIMEOUT:
+            self._disconnect()
+        if self._smtp is None:
+            self._smtp = self._connect()
+        return self._smtp
+
+    def _wait_for_rate_limit(self):
+        if settings.SMTP_RATE_LIMIT <= 0:
+            return
+        now = time.monotonic()
+        if self._next_send_at > now:
+            time.sleep(self._next_send_at - now)
+        self._next_send_at = max(now, self._next_send_at) + 1 / settings.SMTP_RATE_LIMIT
+
+    def _send_one(self, mail: OutgoingMail):
+        msg = MIMEMultipart()
+        msg['From'] = settings.FROM_EMAIL
+        msg['To'] = mail.to_email
+        msg['Subject'] = mail.subject
+        msg.attach(MIMEText(mail.body, 'html'))
+
+        try:
+            self._get_connection().sendmail(settings.FROM_EMAIL, mail.to_email, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # Соединение умерло между письмами - переподключаемся один раз
+            self._smtp = None
+            self._get_connection().sendmail(settings.FROM_EMAIL, mail.to_email, msg.as_string())
+        self._last_used = time.monotonic()
+
+    def _send_batch(self, batch: List[OutgoingMail]):
+        failures = []
+        for mail in batch:
+            self._wait_for_rate_limit()
+            try:
+                self._send_one(mail)
+                self.sent += 1
+            except Exception as e:
+                if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    self._disconnect()
+                failures.append((mail, e))
+        return failures
+
+mail_dispatcher = MailDispatcher()
+register_pool_gauge(
+    "mail_queue_depth", "Emails waiting in the SMTP dispatcher queue",
+    lambda: mail_dispatcher.queue.qsize() if mail_dispatcher.queue is not None else None
+)
@@ -0,0 +1,91 @@
+import html
+import re
+from typing import Any, Dict, List, Tuple
+from sqlalchemy import DateTime, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Маркеры подсветки: заменяются на <mark> уже после экранирования текста сообщения
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+MAX_SEARCH_TERMS = 16
+
+POSTGRES_SEARCH = text("""
+    WITH search AS (
+        SELECT websearch_to_tsquery('russian', :q)
+            || websearch_to_tsquery('english', :q)
+            || websearch_to_tsquery('simple', :q) AS tsq
+    ),
+    hits AS (
+        SELECT m.id, ts_rank_cd(m.search_vector, search.tsq) AS score
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        CROSS JOIN search
+        WHERE c.user_id = :user_id AND m.search_vector @@ search.tsq
+        ORDER BY score DESC, m.id DESC
+        LIMIT :limit OFFSET :offset
+    )
+    -- ts_headline дорогой: считаем его только для строк страницы
+    SELECT m.id, m.conversation_id, c.name AS conversation_name, m.created_at, hits.score,
+           ts_headline('russian', coalesce(m.query, ''), search.tsq, :headline_options) AS query_snippet,
+           ts_headline('russian', coalesce(m.answer, ''), search.tsq, :headline_options) AS answer_snippet
+    FROM hits
+    JOIN messages m ON m.id = hits.id
+    JOIN conversations c ON c.id = m.conversation_id
+    CROSS JOIN search
+    ORDER BY hits.score DESC, m.id DESC
+""").columns(created_at=DateTime)
+
+POSTGRES_HEADLINE_OPTIONS = (
+    f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=35, MinWords=15, MaxFragments=2"
+)
+
+# bm25() в FTS5 тем лучше, чем меньше; вопрос весит вдвое больше ответа
+SQLITE_SEARCH = text("""
+    SELECT m.id, m.conversation_id, c.name AS conversation_name, m.created_at,
+           -bm25(messages_fts, 2.0, 1.0) AS score,
+           snippet(messages_fts, 0, :start, :end, '…', 24) AS query_snippet,
+           snippet(messages_fts, 1, :start, :end, '…', 24) AS answer_snippet
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :match AND c.user_id = :user_id
+    ORDER BY bm25(messages_fts, 2.0, 1.0), m.id DESC
+    LIMIT :limit OFFSET :offset
+""").columns(created_at=DateTime)
+
+def fts5_match_expression(query: str) -> str:
+    """
+    Turn free text into an FTS5 query: every word must match, as a prefix
+    (no stemming in unicode61, so "кодекс" should still find "кодекса").
+    Words are quoted so AND/OR/NEAR and punctuation are never parsed as syntax.
+    """
+    terms = re.findall(r"\w+", query)[:MAX_SEARCH_TERMS]
+    return " ".join(f'"{term}"*' for term in terms)
+
+def render_snippet(snippet: str) -> str:
+    """Escape message text and turn highlight markers into <mark> tags"""
+    return html.escape(snippet or "").replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+async def search_messages(db: AsyncSession, user_id: int, query: str,
+                          limit: int, offset: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Ranked full-text search over the user's messages (query and answer).
+    Returns one page of rows and whether more results follow.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = POSTGRES_SEARCH
+        params = {"q": query, "headline_options": POSTGRES_HEADLINE_OPTIONS}
+    elif dialect == "sqlite":
+        match = fts5_match_expression(query)
+        if not match:
+            return [], False
+        statement = SQLITE_SEARCH
+        params = {"match": match, "start": HIGHLIGHT_START, "end": HIGHLIGHT_END}
+    else:
+        raise RuntimeError(f"Message search is not supported on {dialect}")
+
+    # Лишняя строка показывает, есть ли следующая страница
+    result = await db.execute(statement, {**params, "user_id": user_id, "limit": limit + 1, "offset": offset})
+    rows = [dict(row) for row in result.mappings().all()]
+    return rows[:limit], len(rows) > limit
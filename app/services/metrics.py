@@ -0,0 +1,297 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from config import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Ответы Dify идут секундами и десятками секунд
+DIFY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    """
+    Base for labelled metrics rendered in the Prometheus text exposition format
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples()
+        ]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in items]
+
+class Gauge(Metric):
+    """
+    Gauge that is either set explicitly or read from a callback at scrape time
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        if self._callback is not None:
+            try:
+                values.update(self._callback())
+            except Exception:
+                # Сломанный коллбек не должен ронять весь /metrics
+                pass
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in values.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ключ -> [счетчики по бакетам (+Inf последним), сумма]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+http_requests_total = registry.counter(
+    "http_requests_total", "HTTP requests by method, route template and status", ("method", "route", "status")
+)
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by method and route template", ("method", "route")
+)
+http_requests_in_progress = registry.gauge(
+    "http_requests_in_progress", "HTTP requests currently being served"
+)
+db_query_duration_seconds = registry.histogram(
+    "db_query_duration_seconds", "Database statement execution time by statement type", ("operation",)
+)
+db_query_errors_total = registry.counter(
+    "db_query_errors_total", "Database statements that raised, by statement type", ("operation",)
+)
+db_pool_checkout_seconds = registry.histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a pooled database connection (incl. pre-ping and connect)"
+)
+db_pool_checkout_timeouts_total = registry.counter(
+    "db_pool_checkout_timeouts_total", "Connection checkouts that gave up after DB_POOL_TIMEOUT"
+)
+dify_request_duration_seconds = registry.histogram(
+    "dify_request_duration_seconds", "Dify API call latency by DifyService method and outcome",
+    ("method", "status"), buckets=DIFY_BUCKETS
+)
+answer_cache_requests_total = registry.counter(
+    "answer_cache_requests_total", "Answer cache lookups and writes by result", ("result",)
+)
+
+def register_pool_gauge(name: str, documentation: str, read: Callable[[], Optional[float]]):
+    """Gauge sampled at scrape time; read() returning None hides the sample"""
+    def callback():
+        value = read()
+        return {} if value is None else {(): value}
+    return registry.gauge(name, documentation, callback=callback)
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request counts and latency per route template.
+    Labels use the matched route path ("/api/chat/history/{conversation_id}"),
+    not the raw URL, so cardinality stays bounded.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") == settings.METRICS_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_progress.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            # Для стримов время включает всю передачу ответа
+            http_request_duration_seconds.observe(time.perf_counter() - started, method=method, route=route_path)
+            http_requests_total.inc(method=method, route=route_path, status=str(status_code))
+
+def statement_operation(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+def instrument_engine(engine):
+    """
+    Time every statement through SQLAlchemy cursor events and expose pool gauges.
+    Accepts an AsyncEngine or a sync Engine.
+    """
+    from sqlalchemy import event
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started_at"].pop()
+        db_query_duration_seconds.observe(time.perf_counter() - started, operation=statement_operation(statement))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started_at"):
+            conn.info["query_started_at"].pop()
+        db_query_errors_total.inc(operation=statement_operation(exception_context.statement or ""))
+
+    def pool_stat(method_name: str):
+        def read():
+            # Пул берем при каждом чтении: engine.dispose() подменяет его новым
+            method = getattr(sync_engine.pool, method_name, None)
+            return method() if callable(method) else None
+        return read
+
+    # У NullPool/StaticPool (SQLite) этих методов нет - тогда сэмплы просто не выводятся
+    register_pool_gauge("db_pool_size", "Configured size of the database connection pool", pool_stat("size"))
+    register_pool_gauge("db_pool_checked_out", "Database connections currently checked out", pool_stat("checkedout"))
+    register_pool_gauge("db_pool_overflow", "Database connections opened above the pool size", pool_stat("overflow"))
+    register_pool_gauge("db_pool_checked_in", "Idle database connections in the pool", pool_stat("checkedin"))
+
+    def max_connections():
+        pool = sync_engine.pool
+        size = pool_stat("size")()
+        max_overflow = getattr(pool, "_max_overflow", None)
+        if size is None or max_overflow is None:
+            return None
+        return size + max(max_overflow, 0)
+
+    register_pool_gauge(
+        "db_pool_max_connections", "Upper bound of open connections (pool size plus max overflow)", max_connections
+    )
+
+def render_metrics() -> str:
+    return registry.render()
@@ -1,16 +1,63 @@
 import httpx
+import logging
+import re
 import secrets
-from typing import Optional
-from sqlalchemy.orm import Session
+import time
+from typing import Iterable, Optional
+from jose import JWTError, jwt
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.models import User
-from services.auth_service import create_access_token
+from services.auth_service import create_access_token, invalidate_cached_user
 from config import settings
 
+GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid-configuration"
+GOOGLE_ISSUERS = ("https://accounts.google.com", "accounts.google.com")
+USERNAME_INSERT_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
 class GoogleOAuth:
     def __init__(self):
         self.client_id = settings.GOOGLE_CLIENT_ID
         self.client_secret = settings.GOOGLE_CLIENT_SECRET
         self.redirect_uri = settings.GOOGLE_REDIRECT_URI
+        self._client: Optional[httpx.AsyncClient] = None
+        self._discovery: Optional[dict] = None
+        self._discovery_expires_at = 0.0
+        self._jwks: Optional[dict] = None
+        self._jwks_expires_at = 0.0
+
+    async def start(self):
+        """Open the shared HTTP client (called on application startup)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=settings.OAUTH_HTTP2 and http2_available(),
+                timeout=httpx.Timeout(settings.OAUTH_HTTP_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.OAUTH_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.OAUTH_HTTP_MAX_KEEPALIVE
+                )
+            )
+
+    async def close(self):
+        """Close the shared HTTP client (called on application shutdown)"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        return self._client
         
     def get_auth_url(self) -> str:
         """Generate Google OAuth authorization URL"""
@@ -28,6 +75,28 @@ class GoogleOAuth:
         
         query_string = '&'.join([f"{k}={v}" for k, v in params.items()])
         return f"https://accounts.google.com/o/oauth2/auth?{query_string}", state
+
+    async def _get_cached_json(self, url: str) -> tuple:
+        """GET a JSON document and return it with its expiry, honouring Cache-Control max-age"""
+        client = await self.get_client()
+        response = await client.get(url)
+        response.raise_for_status()
+        max_age = settings.OAUTH_DISCOVERY_CACHE_TTL
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        if match:
+            max_age = int(match.group(1))
+        return response.json(), time.monotonic() + max_age
+
+    async def get_discovery_document(self) -> dict:
+        if self._discovery is None or time.monotonic() >= self._discovery_expires_at:
+            self._discovery, self._discovery_expires_at = await self._get_cached_json(GOOGLE_DISCOVERY_URL)
+        return self._discovery
+
+    async def get_jwks(self, force_refresh: bool = False) -> dict:
+        if force_refresh or self._jwks is None or time.monotonic() >= self._jwks_expires_at:
+            discovery = await self.get_discovery_document()
+            self._jwks, self._jwks_expires_at = await self._get_cached_json(discovery["jwks_uri"])
+        return self._jwks
     
     async def exchange_code_for_token(self, code: str) -> Optional[dict]:
         """Exchange authorization code for access token"""
@@ -41,13 +110,50 @@ class GoogleOAuth:
             'redirect_uri': self.redirect_uri,
         }
         
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(token_url, data=data)
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPError:
+        client = await self.get_client()
+        try:
+            response = await client.post(token_url, data=data)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError:
+            return None
+
+    async def verify_id_token(self, id_token: str, access_token: Optional[str] = None) -> Optional[dict]:
+        """
+        Verify Google's ID token locally against the cached JWKS and return
+        user info in the same shape as the userinfo endpoint
+        """
+        try:
+            kid = jwt.get_unverified_header(id_token).get("kid")
+            jwks = await self.get_jwks()
+            key = next((k for k in jwks.get("keys", []) if k.get("kid") == kid), None)
+            if key is None:
+                # Google ротирует ключи - перечитываем JWKS один раз
+                jwks = await self.get_jwks(force_refresh=True)
+                key = next((k for k in jwks.get("keys", []) if k.get("kid") == kid), None)
+            if key is None:
+                return None
+
+            claims = jwt.decode(
+                id_token,
+                key,
+                algorithms=[key.get("alg", "RS256")],
+                audience=self.client_id,
+                access_token=access_token
+            )
+            if claims.get("iss") not in GOOGLE_ISSUERS:
                 return None
+        except (JWTError, httpx.HTTPError, KeyError, ValueError) as e:
+            logger.warning("ID token verification failed", extra={"error": str(e)})
+            return None
+
+        return {
+            "id": claims.get("sub"),
+            "email": claims.get("email"),
+            "verified_email": claims.get("email_verified"),
+            "name": claims.get("name"),
+            "picture": claims.get("picture")
+        }
     
     async def get_user_info(self, access_token: str) -> Optional[dict]:
         """Get user information from Google"""
@@ -55,31 +161,37 @@ class GoogleOAuth:
         
         headers = {'Authorization': f'Bearer {access_token}'}
         
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(user_info_url, headers=headers)
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPError:
-                return None
+        client = await self.get_client()
+        try:
+            response = await client.get(user_info_url, headers=headers)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError:
+            return None
+
+# Общий экземпляр: HTTP-клиент и кэш JWKS живут в lifespan приложения
+google_oauth = GoogleOAuth()
 
-def create_or_get_oauth_user(db: Session, user_info: dict, provider: str = "google") -> User:
+async def create_or_get_oauth_user(db: AsyncSession, user_info: dict, provider: str = "google") -> User:
     """Create or get existing OAuth user"""
     
 
     if provider == "google" and user_info.get("id"):
-        existing_user = db.query(User).filter(User.google_id == user_info["id"]).first()
+        result = await db.execute(select(User).where(User.google_id == user_info["id"]))
+        existing_user = result.scalars().first()
         if existing_user:
  
             existing_user.avatar_url = user_info.get("picture")
             existing_user.full_name = user_info.get("name")
-            db.commit()
+            await db.commit()
+            invalidate_cached_user(existing_user.email)
             return existing_user
     
 
     email = user_info.get("email")
     if email:
-        existing_user = db.query(User).filter(User.email == email).first()
+        result = await db.execute(select(User).where(User.email == email))
+        existing_user = result.scalars().first()
         if existing_user:
 
             if provider == "google":
@@ -88,44 +200,76 @@ def create_or_get_oauth_user(db: Session, user_info: dict, provider: str = "goog
             existing_user.avatar_url = user_info.get("picture")
             existing_user.full_name = user_info.get("name")
             existing_user.email_verified = True 
-            db.commit()
+            await db.commit()
+            invalidate_cached_user(existing_user.email)
             return existing_user
     
 
-    username = generate_unique_username(db, user_info.get("name", email.split("@")[0]))
-    
-    new_user = User(
-        email=email,
-        username=username,
-        hashed_password=None,  
-        email_verified=True,  
-        oauth_provider=provider,
-        google_id=user_info.get("id") if provider == "google" else None,
-        avatar_url=user_info.get("picture"),
-        full_name=user_info.get("name")
-    )
-    
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    
-    return new_user
+    # В ID token claim "name" может отсутствовать (None) - берем локальную часть email
+    base_username = user_info.get("name") or email.split("@")[0]
+    for _ in range(USERNAME_INSERT_ATTEMPTS):
+        username = await generate_unique_username(db, base_username)
 
-def generate_unique_username(db: Session, base_username: str) -> str:
-    """Generate a unique username"""
+        new_user = User(
+            email=email,
+            username=username,
+            hashed_password=None,  
+            email_verified=True,  
+            oauth_provider=provider,
+            google_id=user_info.get("id") if provider == "google" else None,
+            avatar_url=user_info.get("picture"),
+            full_name=user_info.get("name")
+        )
 
-    base_username = ''.join(c for c in base_username if c.isalnum() or c in '_-')
-    if not base_username:
-        base_username = "user"
-    
+        db.add(new_user)
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Параллельная регистрация заняла то же имя (или тот же email) - пересчитываем
+            await db.rollback()
+            if email:
+                result = await db.execute(select(User).where(User.email == email))
+                existing_user = result.scalars().first()
+                if existing_user:
+                    return existing_user
+            continue
+
+        await db.refresh(new_user)
+        invalidate_cached_user(new_user.email)
+        return new_user
 
-    if not db.query(User).filter(User.username == base_username).first():
+    raise RuntimeError(f"Could not allocate a unique username for {base_username!r}")
+
+def pick_free_username(base_username: str, taken: Iterable[str]) -> str:
+    """Return base_username or base_username<N> with the smallest N not in taken"""
+    suffixes = set()
+    base_taken = False
+    for username in taken:
+        if username == base_username:
+            base_taken = True
+        elif username.startswith(base_username):
+            suffix = username[len(base_username):]
+            if suffix.isascii() and suffix.isdigit() and suffix[0] != "0":
+                suffixes.add(int(suffix))
+    if not base_taken:
         return base_username
-    
 
     counter = 1
-    while True:
-        new_username = f"{base_username}{counter}"
-        if not db.query(User).filter(User.username == new_username).first():
-            return new_username
-        counter += 1
\ No newline at end of file
+    while counter in suffixes:
+        counter += 1
+    return f"{base_username}{counter}"
+
+async def generate_unique_username(db: AsyncSession, base_username: str) -> str:
+    """
+    Generate a unique username in one round-trip: fetch every existing
+    username with the base as prefix and pick the first free numeric suffix
+    """
+
+    base_username = ''.join(c for c in base_username if c.isalnum() or c in '_-')
+    if not base_username:
+        base_username = "user"
+
+    # "_" - спецсимвол LIKE, экранируем
+    pattern = base_username.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    result = await db.execute(select(User.username).where(User.username.like(pattern, escape="\\")))
+    return pick_free_username(base_username, result.scalars().all())
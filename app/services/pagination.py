@@ -0,0 +1,18 @@
+import base64
+import datetime
+import json
+from typing import Optional, Tuple
+
+def encode_cursor(timestamp: Optional[datetime.datetime], row_id: int) -> str:
+    """Encode a (timestamp, id) keyset position as an opaque URL-safe cursor"""
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime.datetime], int]:
+    """Decode a cursor produced by encode_cursor, raising ValueError if it is malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (datetime.datetime.fromisoformat(timestamp) if timestamp else None, int(row_id))
+    except Exception:
+        raise ValueError("Invalid cursor")
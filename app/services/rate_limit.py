@@ -0,0 +1,188 @@
+import json
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from jose import JWTError, jwt
+from config import settings
+from services.cache import TTLCache
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+rate_limited_total = registry.counter(
+    "rate_limited_total", "Requests rejected with 429 by the rate limiter", ("route",)
+)
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """Token bucket: up to `capacity` requests in a burst, refilled at capacity/period per second"""
+    capacity: int
+    period: float
+
+    @property
+    def refill_rate(self) -> float:
+        return self.capacity / self.period
+
+def parse_rules(spec: str) -> Dict[Tuple[str, str], RateLimitRule]:
+    """
+    Parse "METHOD /path=capacity/period_seconds" entries separated by ";",
+    e.g. "POST /api/auth/login=10/60;POST /api/chat/message=30/60"
+    """
+    rules = {}
+    for entry in spec.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            route, limit = entry.rsplit("=", 1)
+            method, path = route.split(None, 1)
+            capacity, period = limit.split("/", 1)
+            rules[(method.upper(), path.strip())] = RateLimitRule(int(capacity), float(period))
+        except ValueError:
+            raise ValueError(f"Invalid RATE_LIMIT_RULES entry: {entry!r}")
+    return rules
+
+class RateLimitBackend:
+    """
+    Storage interface for token buckets; shared backends implement the same method
+    """
+    async def consume(self, key: str, rule: RateLimitRule) -> Tuple[bool, float]:
+        """Take one token; returns (allowed, seconds until a token is available)"""
+        raise NotImplementedError
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """
+    Per-process buckets. Entries expire once the bucket would be full again,
+    and the LRU bound caps memory under a flood of distinct keys.
+    """
+    def __init__(self, maxsize: int):
+        self._buckets = TTLCache(maxsize=maxsize, ttl=60)
+
+    async def consume(self, key: str, rule: RateLimitRule) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (rule.capacity, now))
+        tokens = min(rule.capacity, tokens + (now - updated_at) * rule.refill_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets.set(key, (tokens, now), ttl=rule.period)
+        return allowed, 0.0 if allowed else (1 - tokens) / rule.refill_rate
+
+# Атомарный token bucket в Redis: один round-trip на запрос
+REDIS_TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ttl)
+return {allowed, tostring(tokens)}
+"""
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    Buckets shared by all workers and instances.
+    Needs the optional `redis` package.
+    """
+    def __init__(self, url: str, prefix: str = "rate-limit:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package")
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._script = self._redis.register_script(REDIS_TOKEN_BUCKET)
+        self._prefix = prefix
+
+    async def consume(self, key: str, rule: RateLimitRule) -> Tuple[bool, float]:
+        allowed, tokens = await self._script(
+            keys=[self._prefix + key],
+            args=[rule.capacity, rule.refill_rate, time.time(), max(1, math.ceil(rule.period))]
+        )
+        if allowed:
+            return True, 0.0
+        return False, (1 - float(tokens)) / rule.refill_rate
+
+def create_rate_limit_backend() -> RateLimitBackend:
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        return RedisRateLimitBackend(settings.RATE_LIMIT_REDIS_URL)
+    return InMemoryRateLimitBackend(maxsize=settings.RATE_LIMIT_MAX_KEYS)
+
+def client_identity(scope) -> str:
+    """
+    Authenticated user (JWT subject) when a valid bearer token is present, otherwise the client IP.
+    The token is only decoded here, not looked up - authorization stays in the routes.
+    """
+    headers = dict(scope.get("headers", []))
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if authorization.lower().startswith("bearer "):
+        try:
+            payload = jwt.decode(authorization[7:], settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+            if payload.get("sub"):
+                return f"user:{payload['sub']}"
+        except JWTError:
+            pass
+
+    if settings.RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = headers.get(b"x-forwarded-for", b"").decode("latin-1")
+        if forwarded:
+            return f"ip:{forwarded.split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI token-bucket limiter for the routes listed in RATE_LIMIT_RULES,
+    keyed by route and user/IP. Rejected requests get 429 with Retry-After.
+    """
+    def __init__(self, app, rules: Dict[Tuple[str, str], RateLimitRule] = None,
+                 backend: Optional[RateLimitBackend] = None):
+        self.app = app
+        self.rules = parse_rules(settings.RATE_LIMIT_RULES) if rules is None else rules
+        self.backend = backend or create_rate_limit_backend()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope.get("path", "").rstrip("/") or "/"
+        rule = self.rules.get((scope.get("method", ""), path))
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = f"{scope['method']} {path}|{client_identity(scope)}"
+        try:
+            allowed, retry_after = await self.backend.consume(key, rule)
+        except Exception as e:
+            # Недоступный общий бэкенд не должен класть API - пропускаем запрос
+            logger.warning("Rate limit backend failed, allowing request", extra={"error": str(e)})
+            allowed, retry_after = True, 0.0
+
+        if allowed:
+            await self.app(scope, receive, send)
+            return
+
+        rate_limited_total.inc(route=path)
+        body = json.dumps({"detail": "Too many requests, please try again later"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, Optional
+from sqlalchemy import select, delete, or_
+from config import settings
+from database import SessionLocal, engine
+from models.models import PasswordResetToken, EmailVerificationToken
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TOKEN_MODELS = (PasswordResetToken, EmailVerificationToken)
+
+tokens_swept_total = registry.counter(
+    "tokens_swept_total", "Expired or used auth tokens deleted by the sweeper", ("table",)
+)
+
+token_sweeper_task: Optional[asyncio.Task] = None
+
+async def sweep_table(model, batch_size: int, now: datetime.datetime) -> int:
+    """
+    Delete expired/used rows of one token table in batches of batch_size,
+    committing after each batch so no long transaction holds locks
+    """
+    removed = 0
+    async with SessionLocal() as db:
+        while True:
+            result = await db.execute(
+                select(model.id)
+                .where(or_(model.expires_at < now, model.used == True))
+                .limit(batch_size)
+            )
+            ids = result.scalars().all()
+            if not ids:
+                break
+            await db.execute(delete(model).where(model.id.in_(ids)))
+            await db.commit()
+            removed += len(ids)
+            tokens_swept_total.inc(len(ids), table=model.__tablename__)
+            if len(ids) < batch_size:
+                break
+            # Между пачками отдаем управление обработке запросов
+            await asyncio.sleep(0)
+    return removed
+
+async def sweep_expired_tokens(batch_size: int = None) -> Dict[str, int]:
+    """Remove expired and used reset/verification tokens; returns rows removed per table"""
+    batch_size = batch_size or settings.TOKEN_SWEEP_BATCH_SIZE
+    now = datetime.datetime.utcnow()
+    removed = {}
+    for model in TOKEN_MODELS:
+        removed[model.__tablename__] = await sweep_table(model, batch_size, now)
+    if any(removed.values()):
+        logger.info("Swept expired tokens", extra={"removed": removed})
+    return removed
+
+async def run_token_sweeper():
+    while True:
+        try:
+            await sweep_expired_tokens()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error sweeping expired tokens")
+        await asyncio.sleep(settings.TOKEN_SWEEP_INTERVAL)
+
+def start_token_sweeper():
+    global token_sweeper_task
+    if token_sweeper_task is None or token_sweeper_task.done():
+        token_sweeper_task = asyncio.create_task(run_token_sweeper())
+
+async def stop_token_sweeper():
+    global token_sweeper_task
+    if token_sweeper_task is not None:
+        token_sweeper_task.cancel()
+        try:
+            await token_sweeper_task
+        except asyncio.CancelledError:
+            pass
+        token_sweeper_task = None
+
+async def main():
+    """One-off sweep for cron: cd app && python -m services.token_sweeper"""
+    try:
+        removed = await sweep_expired_tokens()
+    finally:
+        await engine.dispose()
+    for table, count in removed.items():
+        print(f"{table}: removed {count}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+Requests/sec of DifyService against the local stub: a fresh ClientSession
+per call (old behaviour) versus the shared pooled session.
+
+    PYTHONPATH=app python benchmarks/bench_dify_session.py --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import aiohttp
+
+# Меряем только переиспользование сессии: очередь генераций с лимитом на пользователя
+# пропускала бы одновременно лишь несколько запросов одного "bench"
+os.environ.setdefault("DIFY_SCHEDULER_ENABLED", "false")
+
+from stub_dify import start_stub
+from services.dify_service import DifyService
+
+
+class PerCallSessionDifyService(DifyService):
+    """Reproduces the previous behaviour: new session and connector on every call"""
+
+    async def send_message(self, query, user_id, conversation_id=None, inputs=None, files=None):
+        payload = {"query": query, "user": user_id, "response_mode": "blocking", "inputs": inputs or {}}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{self.base_url}/chat-messages", headers=self.headers, json=payload) as response:
+                if response.status != 200:
+                    raise Exception(f"Failed to send message: {await response.text()}")
+                return await response.json()
+
+
+async def run(service: DifyService, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await service.send_message(query=f"question {i}", user_id="bench")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return requests / (time.perf_counter() - started)
+
+
+async def main(args):
+    runner = await start_stub(args.port)
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+    try:
+        before = PerCallSessionDifyService(api_key="bench", base_url=base_url)
+        rps_before = await run(before, args.requests, args.concurrency)
+
+        after = DifyService(api_key="bench", base_url=base_url)
+        await after.start()
+        try:
+            rps_after = await run(after, args.requests, args.concurrency)
+        finally:
+            await after.close()
+    finally:
+        await runner.cleanup()
+
+    print(f"per-call session: {rps_before:8.1f} req/s")
+    print(f"shared session:   {rps_after:8.1f} req/s  ({rps_after / rps_before:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8090)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,110 @@
+"""
+Chat latency (p50/p99) while a burst of logins runs on the same worker.
+
+Drives the FastAPI app in-process over ASGI against SQLite and the local
+Dify stub, so chat requests and bcrypt verifications share one event loop:
+
+    PYTHONPATH=app python benchmarks/bench_login_storm.py --logins 200 --chats 300
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ["DB_CREATE_ALL"] = "true"
+# Шторм логинов и чаты идут с одного IP - лимитер отвечал бы 429 раньше bcrypt
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+# Все чаты от одного пользователя: с лимитом генераций на пользователя мерили бы очередь, а не bcrypt
+os.environ.setdefault("DIFY_SCHEDULER_ENABLED", "false")
+
+from stub_dify import start_stub
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def chat_load(client, headers, count, interval):
+    latencies = []
+
+    async def one(i):
+        started = time.perf_counter()
+        response = await client.post("/api/chat/message", json={"message": f"question {i}"}, headers=headers)
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    tasks = []
+    for i in range(count):
+        tasks.append(asyncio.create_task(one(i)))
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def login_storm(client, count):
+    statuses = {}
+
+    async def one():
+        response = await client.post("/api/auth/login", json={"email": "storm@bench.kz", "password": "password123"})
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    await asyncio.gather(*(one() for _ in range(count)))
+    return statuses
+
+
+def report(label, latencies):
+    print(f"{label:<22} p50={statistics.median(latencies):7.1f} ms  p99={percentile(latencies, 99):7.1f} ms  n={len(latencies)}")
+
+
+async def main(args):
+    os.environ["DIFY_API_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    import httpx
+    import main as app_main
+    from database import SessionLocal
+    from models.models import User
+    from services.auth_service import create_access_token, get_password_hash
+
+    stub = await start_stub(args.port, latency=args.dify_latency)
+    try:
+        async with app_main.app.router.lifespan_context(app_main.app):
+            async with SessionLocal() as db:
+                db.add(User(
+                    email="storm@bench.kz",
+                    username="storm",
+                    hashed_password=await get_password_hash("password123"),
+                    email_verified=True,
+                ))
+                await db.commit()
+
+            headers = {"Authorization": f"Bearer {create_access_token({'sub': 'storm@bench.kz'})}"}
+            transport = httpx.ASGITransport(app=app_main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+                idle = await chat_load(client, headers, args.chats, args.interval)
+                storm_task = asyncio.create_task(login_storm(client, args.logins))
+                during = await chat_load(client, headers, args.chats, args.interval)
+                statuses = await storm_task
+    finally:
+        await stub.cleanup()
+
+    report("chat (idle)", idle)
+    report("chat (login storm)", during)
+    print(f"login statuses: {statuses}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=300)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between chat requests")
+    parser.add_argument("--dify-latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8091)
+    asyncio.run(main(parser.parse_args()))
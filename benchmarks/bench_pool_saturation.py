@@ -0,0 +1,96 @@
+"""
+Database pool saturation and recovery.
+
+Runs three phases against the app's engine (SQLite by default, or any
+DATABASE_URL) with a deliberately small pool. Each worker checks out a
+connection, runs a query and holds the connection for --hold seconds:
+
+    1. baseline  - concurrency below the pool size
+    2. saturate  - concurrency well above size + overflow; checkouts queue and time out
+    3. recover   - back to baseline; waits must return to ~0 and the pool drain
+
+    PYTHONPATH=app python benchmarks/bench_pool_saturation.py --pool-size 4 --overflow 2 --timeout 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--pool-size", type=int, default=4)
+parser.add_argument("--overflow", type=int, default=2)
+parser.add_argument("--timeout", type=float, default=1.0, help="DB_POOL_TIMEOUT")
+parser.add_argument("--hold", type=float, default=0.1, help="seconds each worker keeps its connection")
+parser.add_argument("--baseline", type=int, default=3, help="baseline/recovery concurrency")
+parser.add_argument("--burst", type=int, default=60, help="saturation concurrency")
+parser.add_argument("--phase-seconds", type=float, default=3.0)
+args = parser.parse_args()
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ["DB_POOL_SIZE"] = str(args.pool_size)
+os.environ["DB_MAX_OVERFLOW"] = str(args.overflow)
+os.environ["DB_POOL_TIMEOUT"] = str(args.timeout)
+
+from sqlalchemy import exc, text
+
+from database import engine
+from services.metrics import db_pool_checkout_timeouts_total
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_phase(name, concurrency, duration, hold):
+    waits = []
+    completed = 0
+    timeouts_before = db_pool_checkout_timeouts_total.value()
+    deadline = time.monotonic() + duration
+    timeline = []
+
+    async def worker():
+        nonlocal completed
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                async with engine.connect() as conn:
+                    waits.append(time.perf_counter() - started)
+                    await conn.execute(text("SELECT 1"))
+                    await asyncio.sleep(hold)
+                completed += 1
+            except exc.TimeoutError:
+                waits.append(time.perf_counter() - started)
+
+    async def sampler():
+        pool = engine.sync_engine.pool
+        while time.monotonic() < deadline:
+            timeline.append(pool.checkedout())
+            await asyncio.sleep(duration / 10)
+
+    await asyncio.gather(sampler(), *(worker() for _ in range(concurrency)))
+    timeouts = db_pool_checkout_timeouts_total.value() - timeouts_before
+    print(f"{name:<9} concurrency={concurrency:<3} done={completed:<5} timeouts={int(timeouts):<4} "
+          f"wait p50={percentile(waits, 50) * 1000:7.1f} ms  p99={percentile(waits, 99) * 1000:7.1f} ms  "
+          f"in-use timeline={timeline}")
+
+
+async def main():
+    print(f"pool_size={args.pool_size} max_overflow={args.overflow} timeout={args.timeout}s hold={args.hold}s")
+    await run_phase("baseline", args.baseline, args.phase_seconds, args.hold)
+    await run_phase("saturate", args.burst, args.phase_seconds, args.hold)
+    await run_phase("recover", args.baseline, args.phase_seconds, args.hold)
+    pool = engine.sync_engine.pool
+    print(f"after: checked_out={pool.checkedout()} overflow={pool.overflow()} idle={pool.checkedin()}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,88 @@
+"""
+OAuth username generation with 10k colliding usernames.
+
+Seeds "Aliya", "Aliya1" .. "Aliya9999" into SQLite, then compares the old
+probe-per-candidate loop with the single prefix query used now:
+
+    PYTHONPATH=app python benchmarks/bench_username_generation.py --existing 10000 --runs 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+from sqlalchemy import event, insert, select
+
+from database import Base, SessionLocal, engine
+from models.models import User
+from services.oauth_service import generate_unique_username
+
+BASE_NAME = "Aliya"
+
+
+async def probe_loop_username(db, base_username):
+    """The previous implementation: one SELECT per candidate"""
+    result = await db.execute(select(User.id).where(User.username == base_username))
+    if result.first() is None:
+        return base_username
+    counter = 1
+    while True:
+        new_username = f"{base_username}{counter}"
+        result = await db.execute(select(User.id).where(User.username == new_username))
+        if result.first() is None:
+            return new_username
+        counter += 1
+
+
+async def seed(count):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        rows = [{"email": f"seed{i}@bench.kz", "username": BASE_NAME if i == 0 else f"{BASE_NAME}{i}"} for i in range(count)]
+        # Немного "чужих" имен с тем же префиксом, которые не должны мешать
+        rows += [{"email": f"other{i}@bench.kz", "username": f"{BASE_NAME}_{i}"} for i in range(100)]
+        await conn.execute(insert(User), rows)
+
+
+async def measure(label, generate, runs):
+    statements = 0
+
+    def count_statement(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+    latencies = []
+    try:
+        for _ in range(runs):
+            async with SessionLocal() as db:
+                started = time.perf_counter()
+                username = await generate(db, BASE_NAME)
+                latencies.append((time.perf_counter() - started) * 1000)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", count_statement)
+    print(f"{label:<14} -> {username:<12} median={statistics.median(latencies):8.1f} ms  "
+          f"max={max(latencies):8.1f} ms  queries/call={statements / runs:.0f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--existing", type=int, default=10000, help="colliding usernames to seed")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--loop-runs", type=int, default=3, help="runs for the slow probe loop")
+    args = parser.parse_args()
+
+    await seed(args.existing)
+    await measure("probe loop", probe_loop_username, args.loop_runs)
+    await measure("prefix query", generate_unique_username, args.runs)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,95 @@
+"""
+Local stand-in for the Dify API used by the benchmarks.
+
+Run standalone:
+    python benchmarks/stub_dify.py --port 8089 --latency 0.3 --token-rate 40 --answer-tokens 200
+"""
+import argparse
+import asyncio
+import json
+import uuid
+
+from aiohttp import web
+
+
+def create_app(latency: float = 0.0, token_rate: float = 0.0, answer_tokens: int = 0) -> web.Application:
+    """
+    latency       - seconds before the first token (the whole answer in blocking mode)
+    token_rate    - generated tokens per second (0 = instant); blocking mode waits for all of them
+    answer_tokens - pad answers to this many whitespace-separated tokens
+    """
+    def make_answer(query: str) -> list:
+        tokens = f"Stub answer to: {query}".split(" ")
+        tokens += ["lorem"] * max(0, answer_tokens - len(tokens))
+        return tokens
+
+    async def chat_messages(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        conversation_id = body.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        tokens = make_answer(body.get("query", ""))
+
+        if body.get("response_mode") == "streaming":
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            if latency:
+                await asyncio.sleep(latency)
+            for token in tokens:
+                if token_rate:
+                    await asyncio.sleep(1 / token_rate)
+                event = {
+                    "event": "message",
+                    "answer": token + " ",
+                    "conversation_id": conversation_id,
+                    "message_id": message_id,
+                }
+                await response.write(f"data: {json.dumps(event)}\n\n".encode())
+            event = {"event": "message_end", "conversation_id": conversation_id, "message_id": message_id}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+            return response
+
+        delay = latency + (len(tokens) / token_rate if token_rate else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        return web.json_response({
+            "event": "message",
+            "answer": " ".join(tokens),
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+        })
+
+    async def rename_conversation(request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"id": request.match_info["conversation_id"], "name": body.get("name")})
+
+    async def delete_conversation(request: web.Request) -> web.Response:
+        return web.json_response({"result": "success"})
+
+    async def parameters(request: web.Request) -> web.Response:
+        return web.json_response({"opening_statement": "", "suggested_questions": []})
+
+    app = web.Application()
+    app.router.add_get("/v1/parameters", parameters)
+    app.router.add_post("/v1/chat-messages", chat_messages)
+    app.router.add_post("/v1/conversations/{conversation_id}/name", rename_conversation)
+    app.router.add_delete("/v1/conversations/{conversation_id}", delete_conversation)
+    return app
+
+
+async def start_stub(port: int, latency: float = 0.0, token_rate: float = 0.0, answer_tokens: int = 0) -> web.AppRunner:
+    """Start the stub in the current event loop; caller must `await runner.cleanup()`"""
+    runner = web.AppRunner(create_app(latency, token_rate, answer_tokens))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Dify API stub")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to first token")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second, 0 = instant")
+    parser.add_argument("--answer-tokens", type=int, default=0, help="pad answers to this many tokens")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.token_rate, args.answer_tokens), host="127.0.0.1", port=args.port)